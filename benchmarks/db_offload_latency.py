@@ -0,0 +1,178 @@
+"""Load test: ``ping`` latency while slow ``get_all_users`` calls are in flight.
+
+Starts the WebSocket server against a throwaway SQLite database, seeds it
+with users and makes every user directory query sleep for ``--query-delay``
+seconds to stand in for a slow database. One probe connection sends
+``ping`` in a loop, first on an idle server and then while ``--slow-clients``
+connections hammer ``get_all_users``. With DB work on the executor the two
+p99 figures should stay close; with DB work on the loop the loaded p99
+grows to roughly the query delay. Rate limits are turned off, and the run
+fails if any call comes back with an error, so the figures only measure
+calls that did the work.
+
+    python benchmarks/db_offload_latency.py --slow-clients 8 --query-delay 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def setup_database(user_count, query_delay):
+    from sqlalchemy import event
+    from flaskr.extensions import db
+    from flaskr.models import User
+
+    db.create_all()
+    bench_user = User(name="Bench", username="bench", email="bench@example.com")
+    bench_user.set_password("bench-password")
+    db.session.add(bench_user)
+    db.session.execute(
+        User.__table__.insert(),
+        [
+            {
+                "name": f"User {i}",
+                "username": f"user{i}",
+                "email": f"user{i}@example.com",
+                "password_hash": "x",
+            }
+            for i in range(user_count)
+        ],
+    )
+    db.session.commit()
+
+    def slow_directory_query(conn, cursor, statement, parameters, context, executemany):
+        if "FROM user" in statement and "ORDER BY user.id" in statement:
+            time.sleep(query_delay)
+
+    # RPC handlers query through the WebSocket workload's engine, not db.engine
+    for engine in db.engines.values():
+        event.listen(engine, "before_cursor_execute", slow_directory_query)
+
+
+async def call(ws, request_id, method, params=None):
+    await ws.send(json.dumps({"jsonrpc": "2.0", "id": request_id, "method": method, "params": params or {}}))
+    return json.loads(await ws.recv())
+
+
+async def login(url):
+    import websockets
+
+    ws = await websockets.connect(url, max_size=None)
+    reply = await call(ws, 1, "login", {"username": "bench", "password": "bench-password"})
+    if "error" in reply:
+        raise RuntimeError(f"login failed: {reply['error']}")
+    return ws
+
+
+async def probe(url, duration):
+    ws = await login(url)
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    request_id = 1
+    while time.perf_counter() < deadline:
+        request_id += 1
+        started = time.perf_counter()
+        reply = await call(ws, request_id, "ping")
+        latencies.append((time.perf_counter() - started) * 1000)
+        errors += "error" in reply
+        await asyncio.sleep(0.005)
+    await ws.close()
+    return latencies, errors
+
+
+async def slow_client(ws, stop):
+    request_id = 1
+    errors = 0
+    while not stop.is_set():
+        request_id += 1
+        reply = await call(ws, request_id, "get_all_users", {"limit": 200})
+        errors += "error" in reply
+    await ws.close()
+    return request_id - 1, errors
+
+
+def summarize(label, latencies, errors, db_calls=0, db_errors=0):
+    return {
+        "phase": label,
+        "samples": len(latencies),
+        "errors": errors,
+        "db_calls": db_calls,
+        "db_errors": db_errors,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "max_ms": round(max(latencies), 3),
+    }
+
+
+async def run(args):
+    from flaskr.routes.handlers import start_websocket_server
+
+    server = asyncio.create_task(start_websocket_server("127.0.0.1", args.port))
+    await asyncio.sleep(0.5)
+    url = f"ws://127.0.0.1:{args.port}"
+
+    idle, idle_errors = await probe(url, args.duration)
+
+    # Log the slow clients in up front so password hashing stays out of the window
+    sockets = await asyncio.gather(*(login(url) for _ in range(args.slow_clients)))
+    stop = asyncio.Event()
+    slow = [asyncio.create_task(slow_client(ws, stop)) for ws in sockets]
+    await asyncio.sleep(args.query_delay)
+    loaded, loaded_errors = await probe(url, args.duration)
+    stop.set()
+    counts = await asyncio.gather(*slow)
+
+    server.cancel()
+    return [
+        summarize("idle", idle, idle_errors),
+        summarize(
+            "loaded",
+            loaded,
+            loaded_errors,
+            sum(calls for calls, _ in counts),
+            sum(errors for _, errors in counts),
+        ),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--slow-clients", type=int, default=4)
+    parser.add_argument("--query-delay", type=float, default=0.2)
+    parser.add_argument("--duration", type=float, default=3.0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="ws-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault("SECRET_KEY", "bench-secret")
+    # Rejected calls skip the DB and would hide event-loop stalls
+    os.environ["RATE_LIMIT_ENABLED"] = "false"
+
+    # Importing handlers builds the app and pushes its context
+    import flaskr.routes.handlers  # noqa: F401
+
+    setup_database(args.users, args.query_delay)
+    results = asyncio.run(run(args))
+    print(json.dumps(results, indent=2))
+    failed = sum(phase["errors"] + phase["db_errors"] for phase in results)
+    if failed:
+        raise SystemExit(f"{failed} calls returned errors; latencies are not comparable")
+
+
+if __name__ == "__main__":
+    main()
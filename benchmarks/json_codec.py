@@ -0,0 +1,58 @@
+"""Benchmark: encode/decode throughput of the WebSocket JSON codecs.
+
+Uses a ``get_all_users``-shaped response and a small ``get_user_details``
+request, and reports frames per second for every installed codec.
+
+    python benchmarks/json_codec.py --users 1000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskr.routes.codec import CODECS
+
+
+def make_payloads(user_count):
+    users_result = {
+        "message": "All users fetched",
+        "users": [
+            {"id": i, "username": f"user{i}", "name": f"User Número {i}", "email": f"user{i}@example.com"}
+            for i in range(user_count)
+        ],
+    }
+    request = {"jsonrpc": "2.0", "id": 42, "method": "get_user_details", "params": {}}
+    return users_result, request
+
+
+def rate(func, iterations):
+    seconds = timeit.timeit(func, number=iterations)
+    return int(iterations / seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    users_result, request = make_payloads(args.users)
+    results = []
+    for name, codec in CODECS.items():
+        frame = codec.encode_result(1, users_result)
+        raw_request = codec.dumps(request)
+        results.append({
+            "codec": name,
+            "users_frame_bytes": len(frame),
+            "encode_users_per_sec": rate(lambda: codec.encode_result(1, users_result), args.iterations),
+            "decode_users_per_sec": rate(lambda: codec.loads(frame), args.iterations),
+            "decode_request_per_sec": rate(lambda: codec.loads(raw_request), args.iterations * 50),
+        })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Microbenchmark: cold vs. warm access-token verification.
+
+Cold runs decode and HMAC-check a token every time (cache disabled); warm
+runs hit the verified-token LRU after the first call.
+
+    python benchmarks/token_verify.py --iterations 200000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from collections import namedtuple
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+from flaskr.tokens import TokenService
+
+BenchUser = namedtuple("BenchUser", ["id", "username"])
+
+
+def make_service(cache_size):
+    app = Flask(__name__)
+    app.config.update(
+        JWT_SECRET_KEY="bench-secret",
+        JWT_ALGORITHM="HS256",
+        JWT_CACHE_SIZE=cache_size,
+        JWT_ACCESS_TOKEN_EXPIRES=timedelta(hours=1),
+        JWT_REFRESH_TOKEN_EXPIRES=timedelta(days=7),
+    )
+    return TokenService(app)
+
+
+def bench(label, service, token, iterations):
+    service.verify(token)
+    seconds = timeit.timeit(lambda: service.verify(token), number=iterations)
+    return {
+        "case": label,
+        "iterations": iterations,
+        "us_per_verify": round(seconds / iterations * 1e6, 3),
+        "verifies_per_sec": int(iterations / seconds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    cold = make_service(cache_size=0)
+    warm = make_service(cache_size=10000)
+    token, _ = cold.issue(BenchUser(1, "bench"), "access")
+
+    results = [
+        bench("cold", cold, token, args.iterations),
+        bench("warm", warm, token, args.iterations),
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+"""Load test: thousands of JSON-RPC connections replaying a scripted mix.
+
+Seeds a throwaway SQLite database with one user per connection (grouped
+into chat rooms of ``--room-size``), starts ``start_websocket_server`` in
+a child process and opens ``--connections`` sockets, each authenticated
+with ``auth_with_token``. Every socket then runs a closed loop of calls
+drawn from the mix for ``--duration`` seconds (after ``--warmup``).
+Reports throughput, per-method p50/p95/p99 latency, fan-out notifications
+received, and the server's RSS before and after connecting, per connection.
+
+Mixes are a name from MIXES or ``method=weight`` pairs:
+
+    python benchmarks/ws_load.py --connections 2000 --mix read
+    python benchmarks/ws_load.py --connections 500 --mix "send_message=4,get_messages=1" --output chat.json
+
+Rate limits are switched off in the server unless ``--rate-limits`` is
+given. The output is JSON with sorted keys so runs can be diffed.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = "bench-password"
+
+MIXES = {
+    "read": {"get_user_details": 70, "get_all_users": 20, "ping": 10},
+    "login": {"login": 100},
+    "chat": {"send_message": 80, "get_messages": 20},
+    "mixed": {"get_user_details": 45, "get_all_users": 10, "send_message": 30, "get_messages": 10, "login": 5},
+}
+
+# Request params per method for a given seeded user
+PARAMS = {
+    "ping": lambda user: {},
+    "get_user_details": lambda user: {},
+    "get_all_users": lambda user: {"limit": 50},
+    "login": lambda user: {"username": user["username"], "password": PASSWORD},
+    "send_message": lambda user: {"conversation_id": user["conversation_id"], "body": "benchmark message " * 4},
+    "get_messages": lambda user: {"conversation_id": user["conversation_id"], "limit": 20},
+}
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def parse_mix(spec):
+    if spec in MIXES:
+        return MIXES[spec]
+    mix = {}
+    for item in spec.split(","):
+        method, _, weight = item.partition("=")
+        mix[method.strip()] = float(weight or 1)
+    unknown = set(mix) - set(PARAMS)
+    if unknown:
+        raise SystemExit(f"Unknown methods in mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def setup_database(users, room_size):
+    """Create ``users`` users and their rooms; return one dict per user for the clients."""
+    from flaskr import create_app
+    from flaskr.extensions import db, tokens
+    from flaskr.models import Conversation, ConversationMember, User
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        # Readers and the write-behind batches no longer block each other
+        db.session.execute(db.text("PRAGMA journal_mode=WAL"))
+        template = User(name="Bench", username="bench", email="bench@example.com")
+        template.set_password(PASSWORD)  # hashed once, shared by every user
+        db.session.execute(
+            User.__table__.insert(),
+            [
+                {
+                    "id": i + 1,
+                    "name": f"User {i}",
+                    "username": f"user{i}",
+                    "email": f"user{i}@example.com",
+                    "password_hash": template.password_hash,
+                }
+                for i in range(users)
+            ],
+        )
+        rooms = (users + room_size - 1) // room_size
+        db.session.execute(
+            Conversation.__table__.insert(), [{"id": r + 1, "name": f"Room {r}"} for r in range(rooms)]
+        )
+        db.session.execute(
+            ConversationMember.__table__.insert(),
+            [{"conversation_id": i // room_size + 1, "user_id": i + 1} for i in range(users)],
+        )
+        db.session.commit()
+        return [
+            {
+                "username": f"user{i}",
+                "conversation_id": i // room_size + 1,
+                "access_token": tokens.issue(db.session.get(User, i + 1), "access")[0],
+            }
+            for i in range(users)
+        ]
+
+
+def serve(port, upload_folder):
+    """Child process: run the WebSocket server until SIGTERM."""
+    raise_fd_limit()
+    from flaskr.routes.handlers import app, start_websocket_server
+
+    # create_app always points UPLOAD_FOLDER at ./uploads; keep the run's files in its workdir
+    app.config["UPLOAD_FOLDER"] = upload_folder
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, lambda: stop.done() or stop.set_result(None))
+        await start_websocket_server("127.0.0.1", port, stop=stop)
+
+    asyncio.run(main())
+
+
+def start_server(port, env, upload_folder):
+    # Server logs go to stderr so stdout carries only the report
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", "--port", str(port), "--upload-folder", upload_folder],
+        env=env,
+        stdout=sys.stderr,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"server exited with {server.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise SystemExit("server did not start listening")
+
+
+class Client:
+    """One connection; responses are matched to calls by id, anything else is a notification."""
+
+    def __init__(self, ws, user):
+        self.ws = ws
+        self.user = user
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.notifications = 0
+        self.reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        try:
+            async for frame in self.ws:
+                data = json.loads(frame)
+                for item in data if isinstance(data, list) else [data]:
+                    future = self.pending.pop(item.get("id"), None)
+                    if future is None:
+                        self.notifications += 1
+                    elif not future.done():
+                        future.set_result(item)
+        except Exception:
+            pass
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("connection closed"))
+
+    async def call(self, method, params):
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        await self.ws.send(json.dumps({"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}))
+        return await future
+
+
+async def connect(url, user, handshakes):
+    import websockets
+
+    async with handshakes:
+        ws = await websockets.connect(url, max_size=None, open_timeout=30)
+    client = Client(ws, user)
+    reply = await client.call("auth_with_token", {"access_token": user["access_token"]})
+    if "error" in reply:
+        await ws.close()
+        raise RuntimeError(reply["error"]["message"])
+    return client
+
+
+async def drive(client, methods, weights, measure_from, stop_at, think, samples, errors):
+    while True:
+        method = random.choices(methods, weights)[0]
+        started = time.perf_counter()
+        if started >= stop_at:
+            return
+        try:
+            reply = await client.call(method, PARAMS[method](client.user))
+        except Exception:  # connection closed under us
+            errors[method] = errors.get(method, 0) + 1
+            return
+        if started >= measure_from:
+            if "error" in reply:
+                errors[method] = errors.get(method, 0) + 1
+            else:
+                samples.setdefault(method, []).append((time.perf_counter() - started) * 1000)
+        if think:
+            await asyncio.sleep(random.uniform(0, 2 * think))
+
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "max_ms": round(max(latencies), 3),
+    }
+
+
+async def run(args, users, server_pid):
+    url = f"ws://127.0.0.1:{args.port}"
+    rss_idle = rss_kb(server_pid)
+
+    handshakes = asyncio.Semaphore(args.ramp)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(connect(url, user, handshakes) for user in users), return_exceptions=True)
+    connect_seconds = time.perf_counter() - started
+    clients = [c for c in results if isinstance(c, Client)]
+    failures = [str(e) for e in results if not isinstance(e, Client)]
+    await asyncio.sleep(1)  # let the server settle before measuring memory
+    rss_connected = rss_kb(server_pid)
+
+    mix = parse_mix(args.mix)
+    methods, weights = list(mix), list(mix.values())
+    samples, errors = {}, {}
+    now = time.perf_counter()
+    measure_from = now + args.warmup
+    stop_at = measure_from + args.duration
+
+    peak = [rss_connected or 0]
+
+    async def sample_rss():
+        while True:
+            await asyncio.sleep(0.5)
+            peak[0] = max(peak[0], rss_kb(server_pid) or 0)
+
+    sampler = asyncio.create_task(sample_rss())
+    await asyncio.gather(*(
+        drive(c, methods, weights, measure_from, stop_at, args.think_ms / 1000, samples, errors) for c in clients
+    ))
+    sampler.cancel()
+
+    notifications = sum(c.notifications for c in clients)
+    await asyncio.gather(*(c.ws.close() for c in clients), return_exceptions=True)
+
+    every = [ms for values in samples.values() for ms in values]
+    per_connection = None
+    if rss_idle is not None and rss_connected is not None and clients:
+        per_connection = round((rss_connected - rss_idle) / len(clients), 2)
+    return {
+        "connections": {
+            "requested": len(users),
+            "open": len(clients),
+            "failed": len(failures),
+            "first_failure": failures[0] if failures else None,
+            "connect_seconds": round(connect_seconds, 3),
+        },
+        "server_rss_kb": {
+            "idle": rss_idle,
+            "connected": rss_connected,
+            "peak": peak[0] or None,
+            "per_connection": per_connection,
+        },
+        "requests": len(every),
+        "errors": dict(sorted(errors.items())),
+        "throughput_rps": round(len(every) / args.duration, 1),
+        "notifications": notifications,
+        "latency": summarize(every) if every else None,
+        "methods": {method: summarize(values) for method, values in sorted(samples.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8797)
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--mix", default="read", help=f"one of {', '.join(MIXES)} or 'method=weight,...'")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--think-ms", type=float, default=0.0, help="mean pause between a connection's calls")
+    parser.add_argument("--room-size", type=int, default=5, help="users per chat conversation")
+    parser.add_argument("--ramp", type=int, default=100, help="handshakes in flight while connecting")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the server's rate limits on")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the JSON report here")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--upload-folder", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port, args.upload_folder)
+        return
+
+    parse_mix(args.mix)
+    random.seed(args.seed)
+    fd_limit = raise_fd_limit()
+    if fd_limit < args.connections + 100:
+        raise SystemExit(f"open file limit {fd_limit} is too low for {args.connections} connections")
+
+    workdir = tempfile.mkdtemp(prefix="ws-load-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault("SECRET_KEY", "bench-secret")
+    if not args.rate_limits:
+        os.environ["RATE_LIMIT_ENABLED"] = "false"
+    os.environ.setdefault("WS_MAX_CONNECTIONS", str(args.connections + 100))
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    users = setup_database(args.connections, args.room_size)
+    server = start_server(args.port, dict(os.environ), os.path.join(workdir, "uploads"))
+    try:
+        report = asyncio.run(run(args, users, server.pid))
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+    report["config"] = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "connections": args.connections,
+        "mix": parse_mix(args.mix),
+        "duration": args.duration,
+        "warmup": args.warmup,
+        "think_ms": args.think_ms,
+        "room_size": args.room_size,
+        "rate_limits": args.rate_limits,
+        "server_env": {
+            key: os.environ[key]
+            for key in ("WS_MAX_IN_FLIGHT", "WS_JSON_CODEC", "CHAT_WRITE_MODE", "DB_EXECUTOR_WORKERS")
+            if key in os.environ
+        },
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,203 @@
 import os
+from datetime import timedelta
 from flask import Flask
 from dotenv import load_dotenv
-from .extensions import db, migrate
+from .database import WS_BIND, engine_options
+from .extensions import db, migrate, tokens
+from .logs import logs
+from .metrics import metrics
+from .passwords import stored_method
+
+# The app every server in this process shares; see get_app()
+_shared_app = None
 
 def create_app():
     load_dotenv()
     app = Flask(__name__)
 
     app.config['UPLOAD_FOLDER'] = os.path.join(os.getcwd(), "uploads")
+    # Uploaded images are stored by content hash under UPLOAD_FOLDER/media
+    # and served from MEDIA_URL_PREFIX; thumbnails are rendered per size (px)
+    app.config['MEDIA_URL_PREFIX'] = os.getenv('MEDIA_URL_PREFIX', '/media')
+    # Internal nginx location aliased to UPLOAD_FOLDER/media; when set, /media
+    # responses only carry X-Accel-Redirect and nginx sends the file
+    app.config['MEDIA_X_ACCEL_PREFIX'] = os.getenv('MEDIA_X_ACCEL_PREFIX')
+    app.config['IMAGE_MAX_BYTES'] = int(os.getenv('IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+    app.config['IMAGE_UPLOAD_CHUNK_SIZE'] = int(os.getenv('IMAGE_UPLOAD_CHUNK_SIZE', 64 * 1024))
+    app.config['IMAGE_THUMBNAIL_SIZES'] = [
+        int(size) for size in os.getenv('IMAGE_THUMBNAIL_SIZES', '64,128,256').split(',') if size.strip()
+    ]
 
     app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 
+    app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', app.config['SECRET_KEY'])
+    app.config['JWT_ALGORITHM'] = os.getenv('JWT_ALGORITHM', 'HS256')
+    app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(minutes=int(os.getenv('JWT_ACCESS_TOKEN_MINUTES', 60)))
+    app.config['JWT_REFRESH_TOKEN_EXPIRES'] = timedelta(days=int(os.getenv('JWT_REFRESH_TOKEN_DAYS', 7)))
+    # Number of already-verified tokens kept in memory; 0 disables the cache
+    app.config['JWT_CACHE_SIZE'] = int(os.getenv('JWT_CACHE_SIZE', 10000))
+
+    # Blocking DB calls from the WebSocket loop run on this many threads
+    app.config['DB_EXECUTOR_WORKERS'] = int(os.getenv('DB_EXECUTOR_WORKERS', 8))
+    # Engine profile. Flask requests use the default pool; run_db work gets
+    # its own pool (one connection per DB thread by default) so neither
+    # workload can starve the other. DB_PGBOUNCER turns off server-side
+    # prepared statements for PgBouncer's transaction pooling
+    app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', 5))
+    app.config['DB_MAX_OVERFLOW'] = int(os.getenv('DB_MAX_OVERFLOW', 10))
+    app.config['WS_DB_POOL_SIZE'] = int(os.getenv('WS_DB_POOL_SIZE', app.config['DB_EXECUTOR_WORKERS']))
+    app.config['WS_DB_MAX_OVERFLOW'] = int(os.getenv('WS_DB_MAX_OVERFLOW', 0))
+    app.config['DB_POOL_TIMEOUT'] = float(os.getenv('DB_POOL_TIMEOUT', 30))
+    app.config['DB_POOL_RECYCLE'] = int(os.getenv('DB_POOL_RECYCLE', 1800))
+    app.config['DB_POOL_PRE_PING'] = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+    app.config['DB_QUERY_CACHE_SIZE'] = int(os.getenv('DB_QUERY_CACHE_SIZE', 500))
+    app.config['DB_PGBOUNCER'] = os.getenv('DB_PGBOUNCER', 'false').lower() == 'true'
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+        app.config, 'http', app.config['DB_POOL_SIZE'], app.config['DB_MAX_OVERFLOW']
+    )
+    ws_engine = engine_options(app.config, WS_BIND, app.config['WS_DB_POOL_SIZE'], app.config['WS_DB_MAX_OVERFLOW'])
+    if ws_engine:
+        app.config['SQLALCHEMY_BINDS'] = {WS_BIND: {'url': app.config['SQLALCHEMY_DATABASE_URI'], **ws_engine}}
+    # Password hashing runs in a process pool; changing the method or salt
+    # length makes existing hashes get upgraded on the user's next login
+    app.config['CPU_EXECUTOR_WORKERS'] = int(os.getenv('CPU_EXECUTOR_WORKERS', os.cpu_count() or 1))
+    app.config['PASSWORD_HASH_METHOD'] = stored_method(os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1'))
+    app.config['PASSWORD_SALT_LENGTH'] = int(os.getenv('PASSWORD_SALT_LENGTH', 16))
+
+    # Logs are written by a background thread as JSON lines ('text' for humans).
+    # LOG_SAMPLE_RATES is the share of request frames logged per method, e.g.
+    # "login=1,send_message=0.01,default=0"; secrets are always redacted.
+    # LOG_DEBUG logs every frame and can be flipped at runtime with SIGUSR1
+    app.config['LOG_LEVEL'] = os.getenv('LOG_LEVEL', 'INFO')
+    app.config['LOG_FORMAT'] = os.getenv('LOG_FORMAT', 'json')
+    app.config['LOG_QUEUE_SIZE'] = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+    app.config['LOG_SAMPLE_RATES'] = os.getenv('LOG_SAMPLE_RATES', 'default=0')
+    app.config['LOG_DEBUG'] = os.getenv('LOG_DEBUG', 'false').lower() == 'true'
+
+    # Metrics are kept per process. With several workers on one port, set
+    # METRICS_DIR to a directory they share (run.py and gunicorn.conf.py do)
+    # and /metrics serves every worker's series, labelled by pid
+    app.config['METRICS_DIR'] = os.getenv('METRICS_DIR', '')
+    app.config['METRICS_PUBLISH_INTERVAL'] = float(os.getenv('METRICS_PUBLISH_INTERVAL', 5))
+
+    # JSON-RPC calls slower than this are reported by the timing middleware
+    app.config['RPC_SLOW_CALL_MS'] = float(os.getenv('RPC_SLOW_CALL_MS', 500))
+    # Upper bound on requests accepted in one JSON-RPC batch frame
+    app.config['RPC_MAX_BATCH_SIZE'] = int(os.getenv('RPC_MAX_BATCH_SIZE', 20))
+    # Seconds; RPC_METHOD_TIMEOUTS overrides per method, e.g. "get_all_users=5,login=10"
+    app.config['RPC_DEFAULT_TIMEOUT'] = float(os.getenv('RPC_DEFAULT_TIMEOUT', 30))
+    app.config['RPC_METHOD_TIMEOUTS'] = {
+        name.strip(): float(seconds)
+        for name, seconds in (
+            item.split('=', 1) for item in os.getenv('RPC_METHOD_TIMEOUTS', '').split(',') if '=' in item
+        )
+    }
+    # Requests one connection may have running at once. 1 keeps the old
+    # strictly sequential behaviour; above that responses can arrive out of order
+    app.config['WS_MAX_IN_FLIGHT'] = int(os.getenv('WS_MAX_IN_FLIGHT', 1))
+    # Handshakes beyond this many open connections get a 503; 0 = no limit
+    app.config['WS_MAX_CONNECTIONS'] = int(os.getenv('WS_MAX_CONNECTIONS', 10000))
+    # Under the ASGI server, Flask views run on this many threads per worker
+    app.config['HTTP_WORKER_THREADS'] = int(os.getenv('HTTP_WORKER_THREADS', 10))
+
+    # Token buckets per rate class as "class=per_second/burst". Connection
+    # limits apply to one socket; user limits to a user (or, for auth calls,
+    # a username) across all sockets and, with the redis backend, all nodes
+    app.config['RATE_LIMIT_ENABLED'] = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    app.config['RATE_LIMITS_CONNECTION'] = os.getenv(
+        'RATE_LIMITS_CONNECTION', 'auth=1/10,read=20/50,write=10/30,presence=20/40,default=20/50')
+    app.config['RATE_LIMITS_USER'] = os.getenv(
+        'RATE_LIMITS_USER', 'auth=0.2/10,read=50/100,write=20/60,presence=40/80,default=50/100')
+    app.config['RATE_LIMIT_BACKEND'] = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+    app.config['RATE_LIMIT_REDIS_URL'] = os.getenv('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/0')
+    # 'auto' picks orjson, then ujson, then the stdlib json module
+    app.config['WS_JSON_CODEC'] = os.getenv('WS_JSON_CODEC', 'auto')
+
+    # Per-connection outbound queue. Above the high watermark (bytes) replies
+    # wait and notifications are dropped until it drains below the low one,
+    # or the client is disconnected with WS_SLOW_CONSUMER_POLICY=disconnect.
+    # WS_COALESCE_FRAMES sends queued-up frames as one JSON-RPC batch frame
+    app.config['WS_SEND_HIGH_WATER'] = int(os.getenv('WS_SEND_HIGH_WATER', 1024 * 1024))
+    app.config['WS_SEND_LOW_WATER'] = int(os.getenv('WS_SEND_LOW_WATER', 256 * 1024))
+    app.config['WS_SLOW_CONSUMER_POLICY'] = os.getenv('WS_SLOW_CONSUMER_POLICY', 'drop')
+    app.config['WS_COALESCE_FRAMES'] = os.getenv('WS_COALESCE_FRAMES', 'false').lower() == 'true'
+    app.config['WS_COALESCE_MAX_BYTES'] = int(os.getenv('WS_COALESCE_MAX_BYTES', 64 * 1024))
+
+    # get_all_users is keyset-paginated; clients pass limit up to the max
+    app.config['USER_DIRECTORY_PAGE_SIZE'] = int(os.getenv('USER_DIRECTORY_PAGE_SIZE', 50))
+    app.config['USER_DIRECTORY_MAX_PAGE_SIZE'] = int(os.getenv('USER_DIRECTORY_MAX_PAGE_SIZE', 200))
+
+    app.config['CHAT_MAX_MESSAGE_LENGTH'] = int(os.getenv('CHAT_MAX_MESSAGE_LENGTH', 4000))
+    app.config['CHAT_HISTORY_PAGE_SIZE'] = int(os.getenv('CHAT_HISTORY_PAGE_SIZE', 50))
+    app.config['CHAT_HISTORY_MAX_PAGE_SIZE'] = int(os.getenv('CHAT_HISTORY_MAX_PAGE_SIZE', 200))
+    # get_history answers inline up to one chunk and streams larger backfills
+    app.config['CHAT_HISTORY_CHUNK_SIZE'] = int(os.getenv('CHAT_HISTORY_CHUNK_SIZE', 200))
+    app.config['CHAT_HISTORY_STREAM_LIMIT'] = int(os.getenv('CHAT_HISTORY_STREAM_LIMIT', 10000))
+    # Seconds a single recipient socket may take to accept a fan-out frame
+    app.config['CHAT_SEND_TIMEOUT'] = float(os.getenv('CHAT_SEND_TIMEOUT', 5))
+    # Membership lists of the most recently used conversations, kept for
+    # CHAT_MEMBERSHIP_TTL seconds so sends can skip the membership query
+    app.config['CHAT_MEMBERSHIP_TTL'] = float(os.getenv('CHAT_MEMBERSHIP_TTL', 60))
+    app.config['CHAT_MEMBERSHIP_CACHE_SIZE'] = int(os.getenv('CHAT_MEMBERSHIP_CACHE_SIZE', 10000))
+
+    # Chat messages are persisted write-behind in batches. 'commit' acks a
+    # send once its batch committed; 'enqueue' acks as soon as it is queued
+    app.config['CHAT_WRITE_MODE'] = os.getenv('CHAT_WRITE_MODE', 'commit')
+    app.config['CHAT_WRITE_BATCH_SIZE'] = int(os.getenv('CHAT_WRITE_BATCH_SIZE', 200))
+    app.config['CHAT_WRITE_FLUSH_MS'] = float(os.getenv('CHAT_WRITE_FLUSH_MS', 10))
+    app.config['CHAT_WRITE_QUEUE_LIMIT'] = int(os.getenv('CHAT_WRITE_QUEUE_LIMIT', 10000))
+    app.config['CHAT_WRITE_MAX_ATTEMPTS'] = int(os.getenv('CHAT_WRITE_MAX_ATTEMPTS', 3))
+    # Wait before retrying a failed batch; doubles per attempt, up to 5 s
+    app.config['CHAT_WRITE_RETRY_MS'] = float(os.getenv('CHAT_WRITE_RETRY_MS', 100))
+    # Unique per server process (0-1023); embedded in generated message ids
+    app.config['NODE_ID'] = int(os.getenv('NODE_ID', 0))
+
+    # Cross-process fan-out and presence: 'memory' (single process),
+    # 'postgres' (LISTEN/NOTIFY) or 'redis'. BACKPLANE_URL defaults to the DB
+    # for postgres and is required for redis
+    app.config['BACKPLANE'] = os.getenv('BACKPLANE', 'memory')
+    app.config['BACKPLANE_URL'] = os.getenv('BACKPLANE_URL')
+    app.config['BACKPLANE_CHANNEL'] = os.getenv('BACKPLANE_CHANNEL', 'chat_fanout')
+    app.config['BACKPLANE_FLUSH_MS'] = float(os.getenv('BACKPLANE_FLUSH_MS', 5))
+    app.config['BACKPLANE_HEARTBEAT'] = float(os.getenv('BACKPLANE_HEARTBEAT', 10))
+
+    # Presence/typing changes are batched into one digest per socket per flush
+    app.config['PRESENCE_FLUSH_MS'] = float(os.getenv('PRESENCE_FLUSH_MS', 250))
+    app.config['PRESENCE_TYPING_TTL'] = float(os.getenv('PRESENCE_TYPING_TTL', 5))
+    app.config['PRESENCE_MAX_WATCH'] = int(os.getenv('PRESENCE_MAX_WATCH', 500))
+
+    logs.init_app(app)
+    metrics.init_app(app)
     db.init_app(app)
     migrate.init_app(app, db)
+    tokens.init_app(app)
     # socketio.init_app(app)
 
     # from .routes import api_routes
     # app.register_blueprint(routes.bp)
 
     from .routes import events,api_routes
+    from .routes.message_writer import message_writer
+    from .routes.presence import presence
+    from .routes.ratelimit import rate_limiter
     app.register_blueprint(api_routes.bp)
+    message_writer.init_app(app)
+    presence.init_app(app)
+    rate_limiter.init_app(app)
     # events.register_ws_events(socketio)
 
-    return app
\ No newline at end of file
+    return app
+
+def get_app():
+    """The one app (and so one set of engines) for everything in this process.
+
+    Created on first use. Its app context is pushed so code on the event
+    loop sees ``current_app`` without pushing one per task.
+    """
+    global _shared_app
+    if _shared_app is None:
+        _shared_app = create_app()
+        _shared_app.app_context().push()
+    return _shared_app
\ No newline at end of file
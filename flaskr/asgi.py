@@ -0,0 +1,147 @@
+"""ASGI entry point: the Flask routes and the JSON-RPC WebSocket on one port.
+
+    gunicorn -c gunicorn.conf.py flaskr.asgi:application
+
+WebSocket connections (on any path) go to the same handler the standalone
+``websockets`` server uses; everything else is HTTP and goes to Flask,
+which runs on a thread pool. The app, its engines and the WebSocket
+services (backplane, write-behind writer) are shared by both.
+"""
+from a2wsgi import WSGIMiddleware
+from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
+from websockets.frames import Close
+from flaskr.routes import handlers
+from flaskr.routes.ws_routes import select_subprotocol
+
+
+class ASGIWebSocket:
+    """The parts of a websockets connection the JSON-RPC code uses, over ASGI.
+
+    Iterating yields incoming messages and stops on a normal close; send
+    and recv raise websockets' ConnectionClosed errors, so the handler,
+    outbox and fan-out code cannot tell the two servers apart.
+    """
+
+    def __init__(self, scope, receive, send):
+        self.remote_address = scope.get("client")
+        self.subprotocol = None
+        self._receive = receive
+        self._send = send
+        self._closed = None
+
+    def _error(self):
+        if self._closed.code in (1000, 1001):
+            return ConnectionClosedOK(self._closed, None)
+        return ConnectionClosedError(self._closed, None)
+
+    async def accept(self, subprotocol):
+        self.subprotocol = subprotocol
+        await self._send({"type": "websocket.accept", "subprotocol": subprotocol})
+
+    async def recv(self):
+        if self._closed is not None:
+            raise self._error()
+        message = await self._receive()
+        if message["type"] == "websocket.receive":
+            text = message.get("text")
+            return text if text is not None else message.get("bytes")
+        self._closed = Close(message.get("code", 1005), message.get("reason") or "")
+        raise self._error()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except ConnectionClosedOK:
+            raise StopAsyncIteration
+
+    async def send(self, message, text=None):
+        if self._closed is not None:
+            raise self._error()
+        if isinstance(message, str):
+            event = {"type": "websocket.send", "text": message}
+        elif text:
+            event = {"type": "websocket.send", "text": message.decode()}
+        else:
+            event = {"type": "websocket.send", "bytes": message}
+        try:
+            await self._send(event)
+        except OSError:
+            # The server reports a vanished client as an OSError subclass
+            self._closed = Close(1006, "")
+            raise self._error()
+
+    async def close(self, code=1000, reason=""):
+        if self._closed is None:
+            self._closed = Close(code, reason)
+            try:
+                await self._send({"type": "websocket.close", "code": code, "reason": reason})
+            except OSError:
+                pass
+
+
+class ChatApplication:
+    """Routes ASGI traffic: WebSocket to the JSON-RPC handler, HTTP to Flask."""
+
+    def __init__(self, app):
+        self.app = app
+        self.http = WSGIMiddleware(app, workers=app.config["HTTP_WORKER_THREADS"])
+        self._backplane = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            await self.http(scope, receive, send)
+        elif scope["type"] == "websocket":
+            with self.app.app_context():
+                await self._websocket(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            with self.app.app_context():
+                await self._lifespan(receive, send)
+
+    async def _websocket(self, scope, receive, send):
+        # The first event is always websocket.connect
+        await receive()
+        if not handlers.connection_slots.acquire(self.app.config["WS_MAX_CONNECTIONS"]):
+            await self._reject(scope, send)
+            return
+        try:
+            ws = ASGIWebSocket(scope, receive, send)
+            await ws.accept(select_subprotocol(None, scope.get("subprotocols") or []))
+            await handlers.ws_handler(ws)
+            await ws.close()
+        finally:
+            handlers.connection_slots.release()
+
+    async def _reject(self, scope, send):
+        if "websocket.http.response" in scope.get("extensions", {}):
+            await send({
+                "type": "websocket.http.response.start",
+                "status": 503,
+                "headers": [(b"content-type", b"text/plain"), (b"retry-after", b"5")],
+            })
+            await send({"type": "websocket.http.response.body", "body": b"Too many connections\n"})
+        else:
+            # Closing before the accept is answered with a plain 403
+            await send({"type": "websocket.close", "code": 1013})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    self._backplane = await handlers.start_services()
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                # The server has already closed the sockets; flush what they queued
+                if self._backplane is not None:
+                    await handlers.stop_services(self._backplane)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+application = ChatApplication(handlers.app)
@@ -0,0 +1,78 @@
+import time
+from flask import g
+from flask_sqlalchemy.session import Session
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+from flaskr.metrics import metrics
+
+# Bind key of the engine serving run_db work from the WebSocket loop
+WS_BIND = "ws"
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that reports how long each checkout waited for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Engine.dispose() builds a fresh pool under the same name
+        metrics.pools[self.name] = self
+
+    @property
+    def name(self):
+        return self.logging_name or "default"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.pool_checkout(self.name, time.perf_counter() - started)
+
+
+def is_memory_sqlite(url):
+    url = make_url(url)
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def engine_options(config, name, pool_size, max_overflow):
+    """SQLAlchemy engine options for one workload's pool.
+
+    In-memory SQLite keeps Flask-SQLAlchemy's single shared connection,
+    so it gets no pool settings.
+    """
+    url = config["SQLALCHEMY_DATABASE_URI"]
+    if not url or is_memory_sqlite(url):
+        return {}
+    options = {
+        "poolclass": MeteredQueuePool,
+        "pool_logging_name": name,
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+        # Most recently returned connection first, so idle extras age out
+        "pool_use_lifo": True,
+        "query_cache_size": config["DB_QUERY_CACHE_SIZE"],
+    }
+    if config["DB_PGBOUNCER"] and make_url(url).get_driver_name() == "psycopg":
+        # Transaction pooling may hand each statement to a different server
+        # connection; psycopg 3 must not prepare statements server-side.
+        # psycopg2 never does.
+        options["connect_args"] = {"prepare_threshold": None}
+    return options
+
+
+class WorkloadSession(Session):
+    """Session that sends run_db work to the WebSocket pool.
+
+    run_db marks its app context with ``g.db_workload``; Flask requests,
+    the CLI and migrations leave it unset and use the default engine.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        workload = g.get("db_workload") if g else None
+        if workload is not None and bind is None and engine is self._db.engines.get(None):
+            return self._db.engines.get(workload, engine)
+        return engine
@@ -0,0 +1,89 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from flask import current_app, g
+from flaskr.database import WS_BIND
+from flaskr.metrics import metrics
+
+# Bounded pool for blocking SQLAlchemy work, created lazily from app config
+_db_executor = None
+# Process pool for CPU-bound work (password hashing) that would hold the GIL
+_cpu_executor = None
+
+
+def _get_db_executor(app):
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = ThreadPoolExecutor(
+            max_workers=app.config["DB_EXECUTOR_WORKERS"],
+            thread_name_prefix="db-worker",
+        )
+    return _db_executor
+
+
+def _get_cpu_executor(app):
+    global _cpu_executor
+    if _cpu_executor is None:
+        # spawn, not fork: the parent already runs the loop and DB threads
+        _cpu_executor = ProcessPoolExecutor(
+            max_workers=app.config["CPU_EXECUTOR_WORKERS"],
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _cpu_executor
+
+
+def _call_in_app_context(app, func, args, kwargs):
+    # Flask-SQLAlchemy scopes its session to the app context, so every task
+    # gets a fresh session that is removed when the context is popped.
+    with app.app_context():
+        # Routes the session to the WebSocket workload's own pool
+        g.db_workload = WS_BIND
+        return func(*args, **kwargs)
+
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking DB call on the worker pool without stalling the loop.
+
+    The session is closed once ``func`` returns, so it should hand back
+    plain values (dicts, ids) rather than ORM instances.
+    """
+    app = current_app._get_current_object()
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(
+            _get_db_executor(app),
+            partial(_call_in_app_context, app, func, args, kwargs),
+        )
+    finally:
+        # Includes time queued for a free worker, which is what callers feel
+        metrics.add_db_time(time.perf_counter() - started)
+
+
+async def run_cpu(func, *args):
+    """Run a CPU-bound call in a worker process.
+
+    ``func`` and its arguments are pickled, so ``func`` must be a
+    module-level function working on plain values.
+    """
+    app = current_app._get_current_object()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_cpu_executor(app), func, *args)
+
+
+def call_cpu(func, *args):
+    """Blocking :func:`run_cpu` for request threads outside the event loop."""
+    app = current_app._get_current_object()
+    return _get_cpu_executor(app).submit(func, *args).result()
+
+
+def shutdown_executors(wait=True):
+    global _db_executor, _cpu_executor
+    if _db_executor is not None:
+        _db_executor.shutdown(wait=wait)
+        _db_executor = None
+    if _cpu_executor is not None:
+        _cpu_executor.shutdown(wait=wait)
+        _cpu_executor = None
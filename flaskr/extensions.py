@@ -1,5 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from .database import WorkloadSession
+from .tokens import TokenService
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": WorkloadSession})
 migrate = Migrate() 
+tokens = TokenService()
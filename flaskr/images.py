@@ -0,0 +1,99 @@
+import os
+
+# Pillow format name -> (file extension, content type) for accepted uploads
+IMAGE_FORMATS = {
+    "JPEG": ("jpg", "image/jpeg"),
+    "PNG": ("png", "image/png"),
+    "WEBP": ("webp", "image/webp"),
+    "GIF": ("gif", "image/gif"),
+}
+THUMBNAIL_FORMAT = ("WEBP", "webp", "image/webp")
+
+
+def media_path(media_root, name):
+    """Where a content-addressed file lives: <root>/<first two hex chars>/<name>.
+
+    Sharding by hash prefix keeps any one directory small.
+    """
+    return os.path.join(media_root, name[:2], name)
+
+
+def original_name(content_hash, ext):
+    return f"{content_hash}.{ext}"
+
+
+def thumbnail_name(content_hash, size):
+    return f"{content_hash}_{size}.{THUMBNAIL_FORMAT[1]}"
+
+
+def _write_atomic(path, save):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    save(tmp)
+    os.replace(tmp, path)
+
+
+def process_image(upload_path, media_root, content_hash, sizes):
+    """Validate an uploaded file, store it by content hash and make thumbnails.
+
+    Runs in the CPU process pool. The upload is moved into place (or just
+    deleted, if identical content is already stored) and every thumbnail
+    that does not exist yet is rendered, so re-uploads of the same image
+    cost a hash and a header read. Returns plain metadata for the rows,
+    or None if the file is not a supported image.
+    """
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(upload_path) as image:
+            image.verify()
+        with Image.open(upload_path) as image:
+            fmt = image.format
+            width, height = image.size
+    except Exception:
+        os.remove(upload_path)
+        return None
+    if fmt not in IMAGE_FORMATS:
+        os.remove(upload_path)
+        return None
+
+    ext, content_type = IMAGE_FORMATS[fmt]
+    name = original_name(content_hash, ext)
+    path = media_path(media_root, name)
+    if os.path.exists(path):
+        os.remove(upload_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(upload_path, path)
+
+    variants = [{
+        "variant": "original",
+        "name": name,
+        "content_type": content_type,
+        "width": width,
+        "height": height,
+        "byte_size": os.path.getsize(path),
+    }]
+
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+        for size in sorted(sizes):
+            thumb_name = thumbnail_name(content_hash, size)
+            thumb_path = media_path(media_root, thumb_name)
+            if not os.path.exists(thumb_path):
+                thumb = image.copy()
+                thumb.thumbnail((size, size), Image.Resampling.LANCZOS)
+                _write_atomic(thumb_path, lambda tmp: thumb.save(tmp, THUMBNAIL_FORMAT[0], quality=85))
+            with Image.open(thumb_path) as thumb:
+                thumb_width, thumb_height = thumb.size
+            variants.append({
+                "variant": str(size),
+                "name": thumb_name,
+                "content_type": THUMBNAIL_FORMAT[2],
+                "width": thumb_width,
+                "height": thumb_height,
+                "byte_size": os.path.getsize(thumb_path),
+            })
+    return variants
@@ -0,0 +1,168 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+REDACTED_FIELDS = frozenset({"password", "access_token", "refresh_token"})
+REDACTED = "[redacted]"
+
+frame_log = logging.getLogger("flaskr.frames")
+
+
+def redact(value):
+    """Copy of ``value`` with secret fields masked, however deeply nested."""
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if key in REDACTED_FIELDS and item is not None else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+def parse_rates(spec):
+    """Parse ``"login=1,send_message=0.01"`` into {method: probability}."""
+    rates = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        method, rate = item.split("=", 1)
+        rates[method.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; ``extra={"fields": {...}}`` adds top-level keys."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable lines with the structured fields appended as key=value."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(
+                f"{key}={json.dumps(value, default=str, ensure_ascii=False)}" for key, value in fields.items()
+            )
+        return line
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread without ever blocking the caller.
+
+    Formatting is left to the writer thread; a full queue drops the record
+    and counts it rather than stalling the event loop.
+    """
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    """Routes the ``flaskr`` loggers through a queue to a background writer.
+
+    Request frames are logged per method with the probability given in
+    LOG_SAMPLE_RATES (secrets redacted), so logging costs a dict lookup
+    for frames that are not sampled. Debug mode logs every frame and
+    lowers the level to DEBUG; :meth:`toggle_debug` flips it at runtime
+    (the WebSocket server wires it to SIGUSR1).
+    """
+
+    def __init__(self, app=None):
+        self.debug = False
+        self.level = logging.INFO
+        self.rates = {}
+        self.default_rate = 0.0
+        self._handler = None
+        self._listener = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.rates = parse_rates(app.config["LOG_SAMPLE_RATES"])
+        self.default_rate = self.rates.pop("default", 0.0)
+        self.level = logging.getLevelName(app.config["LOG_LEVEL"].upper())
+        if not isinstance(self.level, int):
+            raise ValueError(f"Unknown LOG_LEVEL '{app.config['LOG_LEVEL']}'")
+        if app.config["LOG_FORMAT"] not in ("json", "text"):
+            raise ValueError(f"Unknown LOG_FORMAT '{app.config['LOG_FORMAT']}'")
+
+        # create_app may run more than once per process; keep one writer
+        if self._listener is None:
+            stream = logging.StreamHandler(sys.stdout)
+            stream.setFormatter(JsonFormatter() if app.config["LOG_FORMAT"] == "json" else TextFormatter())
+            self._handler = _QueueHandler(queue.Queue(app.config["LOG_QUEUE_SIZE"]))
+            self._listener = logging.handlers.QueueListener(self._handler.queue, stream)
+            self._listener.start()
+            logger = logging.getLogger("flaskr")
+            logger.addHandler(self._handler)
+            logger.propagate = False
+            atexit.register(self.close)
+        self.set_debug(app.config["LOG_DEBUG"])
+
+    @property
+    def dropped(self):
+        return self._handler.dropped if self._handler is not None else 0
+
+    def set_debug(self, enabled):
+        self.debug = bool(enabled)
+        logging.getLogger("flaskr").setLevel(logging.DEBUG if self.debug else self.level)
+
+    def toggle_debug(self):
+        self.set_debug(not self.debug)
+        logging.getLogger(__name__).warning(f"Debug logging {'on' if self.debug else 'off'}")
+
+    def frame(self, method, data, user_id=None):
+        """Log a decoded request if its method is sampled (always in debug mode)."""
+        if not self.debug:
+            rate = self.rates.get(method, self.default_rate)
+            if rate <= 0 or (rate < 1 and random.random() >= rate):
+                return
+        frame_log.info("Received", extra={"fields": {"method": method, "user_id": user_id, "frame": redact(data)}})
+
+    def close(self):
+        """Write out whatever is still queued and stop the writer thread."""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+            logging.getLogger("flaskr").removeHandler(self._handler)
+
+
+logs = LogPipeline()
@@ -0,0 +1,251 @@
+import atexit
+import glob
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+log = logging.getLogger(__name__)
+
+# Seconds spent in run_db by the request running in this context
+_db_time = ContextVar("db_time", default=None)
+
+
+class Histogram:
+    """Fixed-bucket histogram.
+
+    Recording is a bisect and two additions on plain lists and floats.
+    Event-loop metrics are recorded without a lock; a scrape from another
+    thread may see one observation half-applied, which Prometheus
+    tolerates.
+    """
+
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+        cumulative += self.counts[-1]
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {cumulative}')
+        labels = labels.rstrip(",")
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.sum}")
+        lines.append(f"{name}_count{suffix} {cumulative}")
+        return lines
+
+
+def _items(mapping):
+    # /metrics renders on an HTTP thread while the event loop adds keys
+    # (first-seen methods, error codes); copy before iterating
+    return sorted(list(mapping.items()))
+
+
+def _with_worker(text, worker):
+    # Labels every sample so series from different processes stay apart
+    lines = []
+    for line in text.splitlines():
+        if not line.startswith("#"):
+            series, value = line.rsplit(" ", 1)
+            name, brace, labels = series.partition("{")
+            line = f'{name}{{worker="{worker}"{"," if brace else "}"}{labels} {value}'
+        lines.append(line)
+    return lines
+
+
+def _merge(expositions):
+    # One HELP/TYPE header per metric, followed by every process's samples
+    families = {}
+    for lines in expositions:
+        family = None
+        for line in lines:
+            if line.startswith("# HELP "):
+                family = families.setdefault(line.split(" ", 3)[2], [line])
+            elif line.startswith("# TYPE "):
+                if len(family) == 1:
+                    family.append(line)
+            else:
+                family.append(line)
+    return "\n".join(line for family in families.values() for line in family) + "\n"
+
+
+class Metrics:
+    """Process-wide RPC and WebSocket metrics, rendered for Prometheus.
+
+    The counters live in this process. When METRICS_DIR is set, every
+    process writes its metrics there every METRICS_PUBLISH_INTERVAL
+    seconds, labelled ``worker="<pid>"``, and :meth:`collect` merges
+    them. A scrape that reaches any one worker behind a shared port then
+    covers all of them; sum over ``worker`` for host-wide figures.
+    """
+
+    def __init__(self):
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))  # method -> seconds
+        self.db_latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))  # method -> seconds in run_db
+        self.frame_bytes = {"in": Histogram(SIZE_BUCKETS), "out": Histogram(SIZE_BUCKETS)}
+        self.errors = defaultdict(int)  # JSON-RPC error code -> count
+        self.pool_wait = defaultdict(lambda: Histogram(LATENCY_BUCKETS))  # pool name -> seconds
+        self.pools = {}  # pool name -> SQLAlchemy pool
+        self._pool_lock = threading.Lock()
+        self._gauges = {}  # name -> (help, kind, callable returning a number)
+        self.started_at = time.time()
+        self.directory = None
+        self.publish_interval = 5.0
+        self._publisher = None
+
+    def init_app(self, app):
+        self.directory = app.config["METRICS_DIR"] or None
+        self.publish_interval = app.config["METRICS_PUBLISH_INTERVAL"]
+        # create_app may run more than once per process; keep one publisher
+        if self.directory and self._publisher is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._publisher = threading.Thread(target=self._publish_loop, name="metrics-publisher", daemon=True)
+            self._publisher.start()
+            atexit.register(self._unpublish)
+
+    def gauge(self, name, help_text, read, kind="gauge"):
+        """Register a value read at scrape time, e.g. a queue length.
+
+        Use ``kind="counter"`` for running totals kept elsewhere.
+        """
+        self._gauges[name] = (help_text, kind, read)
+
+    def start_request(self):
+        """Begin counting DB time for the current request; returns a token for end_request."""
+        return _db_time.set([0.0])
+
+    def end_request(self, method, elapsed, token):
+        db_time = _db_time.get()
+        _db_time.reset(token)
+        self.latency[method].observe(elapsed)
+        if db_time is not None and db_time[0]:
+            self.db_latency[method].observe(db_time[0])
+
+    def add_db_time(self, elapsed):
+        db_time = _db_time.get()
+        if db_time is not None:
+            db_time[0] += elapsed
+
+    def frame(self, direction, size):
+        self.frame_bytes[direction].observe(size)
+
+    def error(self, code):
+        self.errors[code] += 1
+
+    def pool_checkout(self, name, waited):
+        # Checkouts happen on DB and request threads, not the event loop
+        with self._pool_lock:
+            self.pool_wait[name].observe(waited)
+
+    def render(self):
+        lines = [
+            "# HELP rpc_request_duration_seconds JSON-RPC handler time, middleware included.",
+            "# TYPE rpc_request_duration_seconds histogram",
+        ]
+        for method, histogram in _items(self.latency):
+            lines.extend(histogram.render("rpc_request_duration_seconds", f'method="{method}",'))
+        lines += [
+            "# HELP rpc_db_duration_seconds Time a JSON-RPC call spent waiting on run_db.",
+            "# TYPE rpc_db_duration_seconds histogram",
+        ]
+        for method, histogram in _items(self.db_latency):
+            lines.extend(histogram.render("rpc_db_duration_seconds", f'method="{method}",'))
+        lines += [
+            "# HELP rpc_errors_total JSON-RPC error responses by error code.",
+            "# TYPE rpc_errors_total counter",
+        ]
+        for code, count in _items(self.errors):
+            lines.append(f'rpc_errors_total{{code="{code}"}} {count}')
+        lines += [
+            "# HELP ws_frame_bytes WebSocket frame sizes.",
+            "# TYPE ws_frame_bytes histogram",
+        ]
+        for direction, histogram in self.frame_bytes.items():
+            lines.extend(histogram.render("ws_frame_bytes", f'direction="{direction}",'))
+        lines += [
+            "# HELP db_pool_wait_seconds Time a checkout waited for a pooled DB connection, connecting included.",
+            "# TYPE db_pool_wait_seconds histogram",
+        ]
+        for name, histogram in _items(self.pool_wait):
+            lines.extend(histogram.render("db_pool_wait_seconds", f'pool="{name}",'))
+        for metric, help_text, read in (
+            ("db_pool_checked_out", "DB connections currently checked out.", lambda pool: pool.checkedout()),
+            ("db_pool_size", "Configured DB pool size.", lambda pool: pool.size()),
+            ("db_pool_overflow", "DB connections open beyond the pool size.", lambda pool: max(pool.overflow(), 0)),
+        ):
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+            for name, pool in _items(self.pools):
+                lines.append(f'{metric}{{pool="{name}"}} {read(pool)}')
+        for name, (help_text, kind, read) in _items(self._gauges):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {read()}"]
+        lines += [
+            "# HELP process_start_time_seconds Start time of the process since the epoch.",
+            "# TYPE process_start_time_seconds gauge",
+            f"process_start_time_seconds {self.started_at}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def collect(self):
+        """Metrics for /metrics: this process's, or every publishing process's when METRICS_DIR is set."""
+        if not self.directory:
+            return self.render()
+        pid = os.getpid()
+        expositions = [_with_worker(self.render(), pid)]
+        # Files of workers that stopped publishing (exited, killed) age out
+        oldest = time.time() - 3 * self.publish_interval
+        for path in glob.glob(os.path.join(self.directory, "*.prom")):
+            if path == self._path(pid):
+                continue
+            try:
+                if os.path.getmtime(path) < oldest:
+                    os.remove(path)
+                    continue
+                with open(path) as f:
+                    expositions.append(f.read().splitlines())
+            except FileNotFoundError:
+                continue
+        return _merge(expositions)
+
+    def publish(self):
+        """Write this process's metrics to METRICS_DIR for the others to collect."""
+        path = self._path(os.getpid())
+        with open(f"{path}.tmp", "w") as f:
+            f.write("\n".join(_with_worker(self.render(), os.getpid())))
+        os.replace(f"{path}.tmp", path)
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{pid}.prom")
+
+    def _publish_loop(self):
+        while True:
+            try:
+                self.publish()
+            except OSError as e:
+                log.warning(f"Could not publish metrics to {self.directory}: {e}")
+            time.sleep(self.publish_interval)
+
+    def _unpublish(self):
+        try:
+            os.remove(self._path(os.getpid()))
+        except OSError:
+            pass
+
+
+metrics = Metrics()
@@ -1,5 +1,6 @@
 from . import db
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import current_app
+from .passwords import hash_password, verify_password
 from datetime import datetime,timezone
 
 
@@ -20,14 +21,82 @@ class User(db.Model):
     )
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(
+            password,
+            current_app.config["PASSWORD_HASH_METHOD"],
+            current_app.config["PASSWORD_SALT_LENGTH"],
+        )
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
+
+
+# Case-insensitive prefix search in the user directory; text_pattern_ops lets
+# Postgres use these for LIKE 'abc%' regardless of the database collation
+db.Index(
+    "ix_user_lower_username",
+    db.func.lower(User.username).label("lower_username"),
+    postgresql_ops={"lower_username": "text_pattern_ops"},
+)
+db.Index(
+    "ix_user_lower_name",
+    db.func.lower(User.name).label("lower_name"),
+    postgresql_ops={"lower_name": "text_pattern_ops"},
+)
 
 
 class UserImage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     image_url = db.Column(db.String(255), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
\ No newline at end of file
+    created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
+
+    # Uploaded files are stored once per sha256 of their content; each
+    # upload gets one row per variant ("original" or a thumbnail size)
+    content_hash = db.Column(db.String(64), nullable=True, index=True)
+    variant = db.Column(db.String(16), nullable=False, default="original", server_default="original")
+    content_type = db.Column(db.String(32), nullable=True)
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    byte_size = db.Column(db.Integer, nullable=True)
+
+
+db.Index("ix_user_image_user_id_content_hash", UserImage.user_id, UserImage.content_hash)
+
+class Conversation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=True)
+    created_by = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="SET NULL"), nullable=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+    members = db.relationship(
+        "ConversationMember",
+        backref="conversation",
+        cascade="all, delete-orphan",
+        passive_deletes=True
+    )
+
+
+class ConversationMember(db.Model):
+    conversation_id = db.Column(
+        db.Integer, db.ForeignKey("conversation.id", ondelete="CASCADE"), primary_key=True
+    )
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), primary_key=True, index=True
+    )
+    joined_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+class Message(db.Model):
+    # Assigned by flaskr.ids.IdGenerator before insert; 64-bit and time-ordered
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True, autoincrement=False)
+    conversation_id = db.Column(
+        db.Integer, db.ForeignKey("conversation.id", ondelete="CASCADE"), nullable=False
+    )
+    sender_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+# History is read newest-first per conversation with id as the keyset cursor
+db.Index("ix_message_conversation_id_id", Message.conversation_id, Message.id.desc())
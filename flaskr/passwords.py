@@ -0,0 +1,37 @@
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# These run inside the CPU process pool, so they must stay importable
+# top-level functions that only take and return plain values.
+
+
+def hash_password(password, method, salt_length):
+    return generate_password_hash(password, method=method, salt_length=salt_length)
+
+
+def verify_password(password_hash, password):
+    return check_password_hash(password_hash, password)
+
+
+def stored_method(method):
+    """The method prefix werkzeug stores for ``method``, defaults filled in.
+
+    ``"scrypt"`` is stored as ``"scrypt:32768:8:1"`` and ``"pbkdf2:sha256"``
+    with its iteration count, so a configured short form is expanded once
+    by hashing a probe; otherwise every login would look outdated.
+    """
+    if method.count(":") == (3 if method.startswith("scrypt") else 2):
+        # Fully specified already; skip the (deliberately slow) probe
+        return method
+    return generate_password_hash("probe", method=method, salt_length=1).split("$", 1)[0]
+
+
+def needs_rehash(password_hash, method, salt_length):
+    """True when a stored hash was made with different cost settings.
+
+    ``method`` must be in its stored form; see :func:`stored_method`.
+    """
+    try:
+        stored_method, salt, _ = password_hash.split("$", 2)
+    except ValueError:
+        return True
+    return stored_method != method or len(salt) != salt_length
@@ -1,4 +1,15 @@
-from flask import Blueprint, jsonify
+import hashlib
+import os
+import re
+import uuid
+import jwt
+from flask import Blueprint, Response, current_app, jsonify, request, send_file
+from flaskr.models import User, UserImage
+from flaskr.extensions import db, tokens
+from flaskr.executors import call_cpu
+from flaskr.images import IMAGE_FORMATS, media_path, process_image
+from flaskr.metrics import metrics
+from flaskr.routes.principal import invalidate_user
 
 bp = Blueprint('api', __name__)
 
@@ -9,3 +20,173 @@ def home():
 @bp.route('/ping')
 def ping():
     return jsonify({"status": "ok"})
+
+@bp.route('/metrics')
+def prometheus_metrics():
+    # Counters are per process; see Metrics for how workers sharing a port are merged
+    return Response(metrics.collect(), mimetype='text/plain; version=0.0.4')
+
+
+# <sha256>[_<thumbnail size>].<ext>; anything else is not ours to serve
+_MEDIA_NAME = re.compile(r"^[0-9a-f]{64}(?:_[0-9]+)?\.(jpg|png|webp|gif)$")
+_MEDIA_TYPES = {ext: content_type for ext, content_type in IMAGE_FORMATS.values()}
+# Content-addressed files never change, so caches may keep them for a year
+_MEDIA_MAX_AGE = 365 * 24 * 3600
+
+
+def _media_root():
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'media')
+
+
+def _media_url(name):
+    return f"{current_app.config['MEDIA_URL_PREFIX']}/{name}"
+
+
+def _bearer_user_id():
+    """User id from an ``Authorization: Bearer <access token>`` header, or None."""
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return None
+    token = header[len('Bearer '):].strip()
+    try:
+        decoded = tokens.verify(token)
+    except jwt.InvalidTokenError:
+        return None
+    if decoded.get('type') != 'access' or tokens.is_revoked(token):
+        return None
+    return decoded.get('user_id')
+
+
+def _receive_upload(path, max_bytes, chunk_size):
+    """Copy the request body to ``path`` chunk by chunk, hashing as it goes.
+
+    Returns the sha256 hex digest, or None if the body exceeds ``max_bytes``.
+    Only one chunk is ever held in memory.
+    """
+    digest = hashlib.sha256()
+    received = 0
+    with open(path, 'wb') as f:
+        while True:
+            chunk = request.stream.read(chunk_size)
+            if not chunk:
+                break
+            received += len(chunk)
+            if received > max_bytes:
+                return None
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest() if received else None
+
+
+def _record_images(user_id, content_hash, variants):
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    existing = set(db.session.scalars(
+        db.select(UserImage.variant).where(UserImage.user_id == user_id, UserImage.content_hash == content_hash)
+    ))
+    for variant in variants:
+        if variant['variant'] not in existing:
+            db.session.add(UserImage(
+                user_id=user_id,
+                image_url=_media_url(variant['name']),
+                content_hash=content_hash,
+                variant=variant['variant'],
+                content_type=variant['content_type'],
+                width=variant['width'],
+                height=variant['height'],
+                byte_size=variant['byte_size'],
+            ))
+    user.profile_image = _media_url(variants[0]['name'])
+    db.session.commit()
+    return user.profile_image
+
+
+@bp.route('/profile-picture', methods=['PUT', 'POST'])
+def upload_profile_picture():
+    """Stream a raw image body to disk and make it the caller's profile picture.
+
+    The body is the image itself (not a multipart form). Identical images
+    are stored once, and thumbnails are rendered in the CPU process pool.
+    """
+    user_id = _bearer_user_id()
+    if user_id is None:
+        return jsonify({"error": "Valid access token required"}), 401
+
+    max_bytes = current_app.config['IMAGE_MAX_BYTES']
+    if request.content_length is not None and request.content_length > max_bytes:
+        return jsonify({"error": f"Image larger than {max_bytes} bytes"}), 413
+
+    incoming = os.path.join(_media_root(), 'incoming')
+    os.makedirs(incoming, exist_ok=True)
+    upload_path = os.path.join(incoming, uuid.uuid4().hex)
+    try:
+        content_hash = _receive_upload(upload_path, max_bytes, current_app.config['IMAGE_UPLOAD_CHUNK_SIZE'])
+        if content_hash is None:
+            return jsonify({"error": f"Image must be between 1 and {max_bytes} bytes"}), 413
+        variants = call_cpu(
+            process_image, upload_path, _media_root(), content_hash, current_app.config['IMAGE_THUMBNAIL_SIZES']
+        )
+    finally:
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
+
+    if variants is None:
+        return jsonify({"error": "Unsupported or corrupt image"}), 415
+
+    profile_image = _record_images(user_id, content_hash, variants)
+    if profile_image is None:
+        return jsonify({"error": "User not found"}), 404
+    # Connections holding a cached snapshot of this user reload it once
+    invalidate_user(user_id)
+
+    return jsonify({
+        "message": "Profile picture updated successfully",
+        "profile_image": profile_image,
+        "content_hash": content_hash,
+        "thumbnails": {v['variant']: _media_url(v['name']) for v in variants[1:]},
+    }), 201
+
+
+def _immutable(response, etag):
+    response.set_etag(etag)
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = _MEDIA_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+@bp.route('/media/<name>')
+def media(name):
+    """Serve an uploaded image by its content-addressed name.
+
+    The name is the content hash, so it doubles as a strong ETag and the
+    response can be cached forever. Revalidations are answered with 304
+    before the file is even looked at. With MEDIA_X_ACCEL_PREFIX set,
+    nginx is told to send the file itself (with sendfile and range
+    support); otherwise send_file streams it through the WSGI server's
+    file wrapper and handles Range requests.
+    """
+    match = _MEDIA_NAME.match(name)
+    if not match:
+        return jsonify({"error": "Not found"}), 404
+    etag = name.rsplit('.', 1)[0]
+    content_type = _MEDIA_TYPES[match.group(1)]
+
+    if request.if_none_match.contains(etag):
+        return _immutable(Response(status=304), etag)
+
+    path = media_path(_media_root(), name)
+    accel_prefix = current_app.config['MEDIA_X_ACCEL_PREFIX']
+    if accel_prefix:
+        response = Response(content_type=content_type)
+        response.headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{name[:2]}/{name}"
+        return _immutable(response, etag)
+
+    try:
+        response = send_file(path, mimetype=content_type, conditional=True, etag=etag, max_age=_MEDIA_MAX_AGE)
+    except FileNotFoundError:
+        return jsonify({"error": "Not found"}), 404
+    response.accept_ranges = 'bytes'
+    return _immutable(response, etag)
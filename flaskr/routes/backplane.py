@@ -0,0 +1,515 @@
+import asyncio
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flaskr.routes.codec import get_codec
+
+log = logging.getLogger(__name__)
+
+_codec = get_codec()
+
+
+class Backplane:
+    """Carries fan-out and presence between WebSocket server processes.
+
+    Each process (node) delivers to its own sockets through ``fanout`` and
+    forwards an event to the backplane only when a recipient is online on
+    another node. Outgoing events and presence changes are buffered for
+    ``flush_interval`` seconds and sent as one envelope per flush, so a
+    burst of messages costs one publish per node rather than one per event.
+    Events published with the same ``coalesce_key`` inside one flush window
+    collapse to the latest. ``broadcast`` events go to every node whoever
+    is connected there, for state such as token revocations.
+
+    Presence is kept as user_id -> set of remote nodes. A node announces
+    itself and its online users with ``hello`` (peers reply with theirs)
+    on start and after every reconnect, sends
+    deltas as users come and go, and a heartbeat every ``heartbeat``
+    seconds; peers that miss three heartbeats are forgotten.
+
+    Subclasses implement ``_connect``, ``_send(payload)`` and
+    ``_disconnect`` and call ``_receive(payload)`` for every envelope.
+    """
+
+    # Largest envelope the transport accepts, in bytes; None for no limit
+    max_payload = None
+
+    def __init__(self, flush_interval=0.005, heartbeat=10):
+        self.node = uuid.uuid4().hex[:12]
+        self.flush_interval = flush_interval
+        self.heartbeat = heartbeat
+        self._fanout = None
+        self._events = []
+        self._coalesced = {}  # coalesce_key -> index in _events
+        self._online = set()
+        self._offline = set()
+        self._control = {}
+        self._remote_users = {}  # user_id -> {node}
+        self._remote_nodes = {}  # node -> ({user_id}, last seen)
+        self._pending = None
+        self._loop = None
+        self._tasks = []
+
+    async def start(self, fanout):
+        self._fanout = fanout
+        self._pending = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        await self._connect()
+        self._tasks = [
+            asyncio.create_task(self._run()),
+            asyncio.create_task(self._beat()),
+        ]
+        self._hello()
+
+    async def close(self):
+        """Tell peers this node is gone, flush what is buffered and disconnect."""
+        if self._pending is None:
+            return
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._control["bye"] = True
+        try:
+            await self._flush()
+        except Exception as e:
+            log.error(f"Backplane flush on close failed: {e}")
+        await self._disconnect()
+        self._pending = None
+
+    # -- outgoing ---------------------------------------------------------
+
+    def publish(self, user_ids, method, params, coalesce_key=None):
+        """Queue a notification for the recipients that live on other nodes."""
+        remote = [user_id for user_id in user_ids if user_id in self._remote_users]
+        if not remote or self._pending is None:
+            return False
+        event = [remote, method, params]
+        index = self._coalesced.get(coalesce_key) if coalesce_key is not None else None
+        if index is not None:
+            self._events[index] = event
+        else:
+            if coalesce_key is not None:
+                self._coalesced[coalesce_key] = len(self._events)
+            self._events.append(event)
+        self._pending.set()
+        return True
+
+    def broadcast(self, method, params):
+        """Queue a notification for every other node; safe from any thread.
+
+        Receivers handle it through a ``fanout.routes`` entry with
+        ``user_ids`` of None.
+        """
+        if self._pending is None:
+            return False
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._queue_broadcast(method, params)
+        else:
+            self._loop.call_soon_threadsafe(self._queue_broadcast, method, params)
+        return True
+
+    def _queue_broadcast(self, method, params):
+        if self._pending is not None:
+            self._events.append([None, method, params])
+            self._pending.set()
+
+    def user_online(self, user_id):
+        self._offline.discard(user_id)
+        self._online.add(user_id)
+        if self._pending is not None:
+            self._pending.set()
+
+    def user_offline(self, user_id):
+        self._online.discard(user_id)
+        self._offline.add(user_id)
+        if self._pending is not None:
+            self._pending.set()
+
+    def _hello(self):
+        # Also re-announce everyone connected here: after an outage, peers
+        # may have expired this node and forgotten its users
+        online = set(self._fanout.online_users())
+        self._offline -= online
+        self._online |= online
+        self._control["hello"] = True
+        self._pending.set()
+
+    async def _run(self):
+        retry_delay = self.flush_interval
+        while True:
+            await self._pending.wait()
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self._flush()
+            except Exception as e:
+                # The unsent buffers were queued again; back off before retrying
+                log.error(f"Backplane publish failed, retrying in {retry_delay:.2f}s: {e}")
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2 or 0.1, 5)
+            else:
+                retry_delay = self.flush_interval
+
+    async def _beat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            self._expire_nodes()
+            self._control["beat"] = True
+            self._pending.set()
+
+    async def _flush(self):
+        self._pending.clear()
+        if not (self._events or self._online or self._offline or self._control):
+            return
+        # Swap the buffers out so events queued during the send start a new batch
+        events, coalesced = self._events, self._coalesced
+        online, offline, control = self._online, self._offline, self._control
+        self._events = []
+        self._coalesced = {}
+        self._online = set()
+        self._offline = set()
+        self._control = {}
+
+        envelope = {"node": self.node, **control}
+        if events:
+            envelope["events"] = events
+        if online:
+            envelope["online"] = list(online)
+        if offline:
+            envelope["offline"] = list(offline)
+        parts = self._pack(envelope)
+        for part, payload in parts:
+            try:
+                await self._send(payload)
+            except Exception:
+                self._requeue([part, *(rest for rest, _ in parts)], coalesced, events)
+                raise
+
+    def _requeue(self, parts, coalesced, events):
+        """Put envelope parts that were not sent back ahead of newer buffers.
+
+        Anything queued since the swap is newer, so it wins: a coalesced
+        event replaces the unsent one with the same key, and a user who
+        went online (or offline) since overrides the unsent opposite.
+        """
+        key_of = {id(events[index]): key for key, index in coalesced.items()}
+        newer, newer_keys = self._events, {index: key for key, index in self._coalesced.items()}
+        self._events, self._coalesced = [], {}
+        online, offline = set(), set()
+        for part in parts:
+            for event in part.get("events", ()):
+                key = key_of.get(id(event))
+                if key is not None:
+                    self._coalesced[key] = len(self._events)
+                self._events.append(event)
+            online.update(part.get("online", ()))
+            offline.update(part.get("offline", ()))
+            for flag in ("hello", "beat", "bye"):
+                if part.get(flag):
+                    self._control.setdefault(flag, True)
+        for index, event in enumerate(newer):
+            key = newer_keys.get(index)
+            if key in self._coalesced:
+                self._events[self._coalesced[key]] = event
+                continue
+            if key is not None:
+                self._coalesced[key] = len(self._events)
+            self._events.append(event)
+        self._online = (online - self._offline) | self._online
+        self._offline = (offline - self._online) | self._offline
+        self._pending.set()
+
+    def _pack(self, envelope):
+        """Yield ``(part, payload)``, splitting the lists until each part fits."""
+        payload = _codec.dumps(envelope)
+        if self.max_payload is None or len(payload) <= self.max_payload:
+            yield envelope, payload
+            return
+        for key in ("events", "online", "offline"):
+            items = envelope.get(key)
+            if items and len(items) > 1:
+                half = len(items) // 2
+                yield from self._pack({**envelope, key: items[:half]})
+                rest = {"node": self.node, key: items[half:]}
+                yield from self._pack(rest)
+                return
+        log.warning(f"Dropping backplane envelope of {len(payload)} bytes (limit {self.max_payload})")
+
+    # -- incoming ---------------------------------------------------------
+
+    def _receive(self, payload):
+        try:
+            envelope = _codec.loads(payload)
+            node = envelope["node"]
+        except (ValueError, TypeError, KeyError) as e:
+            log.warning(f"Ignoring malformed backplane envelope: {e}")
+            return
+        if node == self.node:
+            return
+
+        if envelope.get("bye"):
+            self._forget_node(node)
+            return
+
+        users, _ = self._remote_nodes.get(node) or (set(), None)
+        self._remote_nodes[node] = (users, time.monotonic())
+        for user_id in envelope.get("online", ()):
+            users.add(user_id)
+            self._remote_users.setdefault(user_id, set()).add(node)
+            self._fanout.presence_changed(user_id)
+        for user_id in envelope.get("offline", ()):
+            users.discard(user_id)
+            self._drop_remote_user(user_id, node)
+            self._fanout.presence_changed(user_id)
+
+        if envelope.get("hello"):
+            # A new peer: let it know who is connected here
+            self._online.update(self._fanout.online_users())
+            self._pending.set()
+
+        for user_ids, method, params in envelope.get("events", ()):
+            self._fanout.deliver_remote(user_ids, method, params)
+
+    def _drop_remote_user(self, user_id, node):
+        nodes = self._remote_users.get(user_id)
+        if nodes is not None:
+            nodes.discard(node)
+            if not nodes:
+                del self._remote_users[user_id]
+
+    def _forget_node(self, node):
+        users, _ = self._remote_nodes.pop(node, (set(), None))
+        for user_id in users:
+            self._drop_remote_user(user_id, node)
+            self._fanout.presence_changed(user_id)
+
+    def _expire_nodes(self):
+        deadline = time.monotonic() - 3 * self.heartbeat
+        for node, (_, last_seen) in list(self._remote_nodes.items()):
+            if last_seen < deadline:
+                log.warning(f"Backplane node {node} stopped responding")
+                self._forget_node(node)
+
+    def is_online(self, user_id):
+        """True if ``user_id`` has a socket on some other node."""
+        return user_id in self._remote_users
+
+    def nodes(self):
+        return list(self._remote_nodes)
+
+    # -- transport --------------------------------------------------------
+
+    async def _connect(self):
+        raise NotImplementedError
+
+    async def _send(self, payload):
+        raise NotImplementedError
+
+    async def _disconnect(self):
+        pass
+
+
+class LocalHub:
+    """In-process stand-in for a pub/sub server.
+
+    Backplanes sharing a hub see each other's envelopes, so several
+    "nodes" can run inside one test process without Redis or Postgres.
+    """
+
+    def __init__(self):
+        self.members = set()
+
+    def deliver(self, sender, payload):
+        for member in self.members:
+            if member is not sender:
+                asyncio.get_running_loop().call_soon(member._receive, payload)
+
+
+class InMemoryBackplane(Backplane):
+    """Backplane for single-process runs and tests.
+
+    Without a shared ``hub`` it is a no-op: there are no peers, so
+    nothing is ever forwarded.
+    """
+
+    def __init__(self, hub=None, **kwargs):
+        super().__init__(**kwargs)
+        self.hub = hub if hub is not None else LocalHub()
+
+    async def _connect(self):
+        self.hub.members.add(self)
+
+    async def _send(self, payload):
+        self.hub.deliver(self, payload)
+
+    async def _disconnect(self):
+        self.hub.members.discard(self)
+
+
+class PostgresBackplane(Backplane):
+    """LISTEN/NOTIFY on the database the app already uses.
+
+    One autocommit connection LISTENs and is polled from the event loop;
+    a second one sends NOTIFYs from a dedicated thread. NOTIFY payloads
+    are capped by Postgres at 8000 bytes, so envelopes are split to fit.
+    """
+
+    max_payload = 7900
+
+    def __init__(self, url, channel="chat_fanout", **kwargs):
+        super().__init__(**kwargs)
+        from sqlalchemy.engine import make_url
+
+        # psycopg2 takes libpq URIs, not SQLAlchemy driver names
+        self.dsn = make_url(url).set(drivername="postgresql").render_as_string(hide_password=False)
+        self.channel = channel
+        self._listener = None
+        self._notifier = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backplane")
+        self._reconnecting = None
+
+    def _open(self):
+        import psycopg2
+        from psycopg2 import sql
+        from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+        listener = psycopg2.connect(self.dsn)
+        listener.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with listener.cursor() as cursor:
+            cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+        notifier = psycopg2.connect(self.dsn)
+        notifier.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        return listener, notifier
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        self._listener, self._notifier = await loop.run_in_executor(self._executor, self._open)
+        loop.add_reader(self._listener.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        try:
+            self._listener.poll()
+        except Exception as e:
+            log.error(f"Backplane connection lost: {e}")
+            self._close_connections()
+            if self._reconnecting is None:
+                self._reconnecting = asyncio.create_task(self._reconnect())
+            return
+        while self._listener.notifies:
+            self._receive(self._listener.notifies.pop(0).payload)
+
+    async def _reconnect(self, delay=1):
+        while self._pending is not None:
+            await asyncio.sleep(delay)
+            try:
+                await self._connect()
+            except Exception as e:
+                log.error(f"Backplane reconnect failed: {e}")
+                delay = min(delay * 2, 30)
+                continue
+            log.info("Backplane reconnected")
+            self._reconnecting = None
+            self._hello()
+            return
+
+    def _notify(self, payload):
+        with self._notifier.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+
+    async def _send(self, payload):
+        if self._notifier is None:
+            raise ConnectionError("backplane is reconnecting")
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._notify, payload.decode())
+
+    def _close_connections(self):
+        if self._listener is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self._listener.fileno())
+            except (ValueError, OSError):
+                pass
+        for conn in (self._listener, self._notifier):
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        self._listener = self._notifier = None
+
+    async def _disconnect(self):
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+        self._close_connections()
+        self._executor.shutdown(wait=False)
+
+
+class RedisBackplane(Backplane):
+    """Redis pub/sub; needs the optional ``redis`` package."""
+
+    def __init__(self, url, channel="chat_fanout", **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+        self.channel = channel
+        self._redis = None
+        self._pubsub = None
+        self._reader = None
+
+    async def _connect(self):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("BACKPLANE=redis needs the 'redis' package installed")
+        self._redis = redis.from_url(self.url)
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.subscribe(self.channel)
+        self._reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        while True:
+            try:
+                async for message in self._pubsub.listen():
+                    if message["type"] == "message":
+                        self._receive(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # redis-py reconnects the pubsub connection on the next listen()
+                log.error(f"Backplane connection lost: {e}")
+                await asyncio.sleep(1)
+                self._hello()
+
+    async def _send(self, payload):
+        await self._redis.publish(self.channel, payload)
+
+    async def _disconnect(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            await asyncio.gather(self._reader, return_exceptions=True)
+        await self._pubsub.aclose()
+        await self._redis.aclose()
+
+
+def create_backplane(app):
+    """Build the backplane selected by the BACKPLANE config value."""
+    kind = app.config["BACKPLANE"]
+    options = {
+        "flush_interval": app.config["BACKPLANE_FLUSH_MS"] / 1000,
+        "heartbeat": app.config["BACKPLANE_HEARTBEAT"],
+    }
+    if kind == "memory":
+        return InMemoryBackplane(**options)
+    url = app.config["BACKPLANE_URL"] or app.config["SQLALCHEMY_DATABASE_URI"]
+    if kind == "postgres":
+        if app.config["DB_PGBOUNCER"] and not app.config["BACKPLANE_URL"]:
+            # LISTEN only hears notifications on the server connection that ran it
+            log.warning("BACKPLANE=postgres behind PgBouncer needs BACKPLANE_URL pointing at Postgres directly")
+        return PostgresBackplane(url, app.config["BACKPLANE_CHANNEL"], **options)
+    if kind == "redis":
+        if not app.config["BACKPLANE_URL"]:
+            # The DB URL is no use to a Redis client; fail here, not on the first reconnect
+            raise ValueError("BACKPLANE=redis needs BACKPLANE_URL, e.g. redis://localhost:6379/0")
+        return RedisBackplane(url, app.config["BACKPLANE_CHANNEL"], **options)
+    raise ValueError(f"Unknown BACKPLANE '{kind}'")
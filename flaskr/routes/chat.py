@@ -0,0 +1,270 @@
+import time
+from collections import OrderedDict
+from datetime import timezone
+from flask import current_app
+from flaskr.models import User, Conversation, ConversationMember, Message
+from flaskr.extensions import db
+from flaskr.executors import run_db
+from flaskr.routes.dispatcher import rpc
+from flaskr.routes.fanout import fanout
+from flaskr.routes.message_writer import message_writer
+
+# conversation_id -> (member ids, monotonic fetch time), least recently
+# used first; lets sends skip the membership query, which would otherwise
+# undo the point of write-behind
+_member_cache = OrderedDict()
+
+
+def _utc_timestamp(value):
+    """ISO 8601 in UTC with a ``Z`` suffix; naive values (as read back from the DB) are UTC."""
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(timespec="microseconds") + "Z"
+
+
+def _message_dict(message):
+    # Message ids are above 2**53, past what a JavaScript number holds exactly
+    return {
+        "id": str(message.id),
+        "conversation_id": message.conversation_id,
+        "sender_id": message.sender_id,
+        "body": message.body,
+        "created_at": _utc_timestamp(message.created_at),
+    }
+
+
+def _member_ids(conversation_id):
+    return list(db.session.scalars(
+        db.select(ConversationMember.user_id).where(ConversationMember.conversation_id == conversation_id)
+    ))
+
+
+def _is_member(conversation_id, user_id):
+    return db.session.get(ConversationMember, (conversation_id, user_id)) is not None
+
+
+def _create_conversation(creator_id, member_ids, name):
+    member_ids = set(member_ids) | {creator_id}
+    found = set(db.session.scalars(db.select(User.id).where(User.id.in_(member_ids))))
+    if found != member_ids:
+        return None
+
+    conversation = Conversation(name=name, created_by=creator_id)
+    conversation.members = [ConversationMember(user_id=user_id) for user_id in sorted(member_ids)]
+    db.session.add(conversation)
+    db.session.commit()
+    return {"id": conversation.id, "name": conversation.name, "member_ids": sorted(member_ids)}
+
+
+def _list_conversations(user_id):
+    rows = db.session.execute(
+        db.select(Conversation.id, Conversation.name)
+        .join(ConversationMember, ConversationMember.conversation_id == Conversation.id)
+        .where(ConversationMember.user_id == user_id)
+        .order_by(Conversation.id)
+    ).all()
+    return [{"id": row.id, "name": row.name} for row in rows]
+
+
+def _cache_members(conversation_id, member_ids):
+    _member_cache[conversation_id] = (member_ids, time.monotonic())
+    _member_cache.move_to_end(conversation_id)
+    while len(_member_cache) > current_app.config["CHAT_MEMBERSHIP_CACHE_SIZE"]:
+        _member_cache.popitem(last=False)
+
+
+async def _cached_member_ids(conversation_id, max_age=None):
+    """Member ids of a conversation, queried only when not cached within ``max_age`` seconds.
+
+    ``max_age`` defaults to CHAT_MEMBERSHIP_TTL.
+    """
+    if max_age is None:
+        max_age = current_app.config["CHAT_MEMBERSHIP_TTL"]
+    cached = _member_cache.get(conversation_id)
+    if cached and time.monotonic() - cached[1] < max_age:
+        _member_cache.move_to_end(conversation_id)
+        return cached[0]
+    member_ids = frozenset(await run_db(_member_ids, conversation_id))
+    _cache_members(conversation_id, member_ids)
+    return member_ids
+
+
+def _history_page(conversation_id, before_id, limit):
+    """Newest-first page of messages older than ``before_id``.
+
+    Walks the (conversation_id, id DESC) index, so every page costs the
+    same no matter how far back it is.
+    """
+    query = db.select(Message).where(Message.conversation_id == conversation_id)
+    if before_id is not None:
+        query = query.where(Message.id < before_id)
+    messages = db.session.scalars(query.order_by(Message.id.desc()).limit(limit)).all()
+    return [_message_dict(message) for message in messages]
+
+
+def _recent_messages(conversation_id, user_id, limit):
+    if not _is_member(conversation_id, user_id):
+        return None
+    return list(reversed(_history_page(conversation_id, None, limit)))
+
+
+def _parse_int(value):
+    if isinstance(value, bool):
+        raise ValueError("not an integer")
+    return int(value)
+
+
+@rpc.method("create_conversation", auth=True, rate_class="write")
+async def handle_create_conversation(params, current_user=None):
+    name = params.get("name")
+    try:
+        member_ids = [_parse_int(user_id) for user_id in params.get("member_ids") or []]
+    except (TypeError, ValueError):
+        return {"error": "member_ids must be a list of user ids", "code": -32602}
+
+    if not member_ids:
+        return {"error": "At least one member required", "code": -32602}
+
+    conversation = await run_db(_create_conversation, current_user.id, member_ids, name)
+    if not conversation:
+        return {"error": "User not found", "code": -32602}
+    _cache_members(conversation["id"], frozenset(conversation["member_ids"]))
+
+    return {
+        "message": "Conversation created",
+        "conversation": conversation,
+    }
+
+
+@rpc.method("get_conversations", auth=True, rate_class="read")
+async def get_conversations(params, current_user=None):
+    return {
+        "message": "Conversations fetched",
+        "conversations": await run_db(_list_conversations, current_user.id),
+    }
+
+
+@rpc.method("send_message", auth=True, session=True, rate_class="write")
+async def handle_send_message(params, current_user=None, session=None):
+    body = params.get("body")
+    try:
+        conversation_id = _parse_int(params.get("conversation_id"))
+    except (TypeError, ValueError):
+        return {"error": "conversation_id required", "code": -32602}
+
+    if not isinstance(body, str) or not body.strip():
+        return {"error": "Message body required", "code": -32602}
+    if len(body) > current_app.config["CHAT_MAX_MESSAGE_LENGTH"]:
+        return {"error": "Message too long", "code": -32602}
+
+    member_ids = await _cached_member_ids(conversation_id)
+    if current_user.id not in member_ids:
+        return {"error": "Conversation not found", "code": -32602}
+
+    try:
+        row = await message_writer.submit(conversation_id, current_user.id, body)
+    except Exception:
+        return {"error": "Message could not be saved", "code": -32000}
+    message = {**row, "id": str(row["id"]), "created_at": _utc_timestamp(row["created_at"])}
+
+    # Deliver in the background so the sender's ack never waits on slow members
+    fanout.publish_soon(
+        member_ids,
+        "new_message",
+        message,
+        exclude=session.get("ws") if session else None,
+        timeout=current_app.config["CHAT_SEND_TIMEOUT"],
+    )
+
+    return {
+        "message": "Message sent",
+        "message_id": message["id"],
+        "conversation_id": message["conversation_id"],
+        "created_at": message["created_at"],
+    }
+
+
+@rpc.method("get_messages", auth=True, rate_class="read")
+async def get_messages(params, current_user=None):
+    max_limit = current_app.config["CHAT_HISTORY_MAX_PAGE_SIZE"]
+    try:
+        conversation_id = _parse_int(params.get("conversation_id"))
+        limit = _parse_int(params.get("limit") or current_app.config["CHAT_HISTORY_PAGE_SIZE"])
+    except (TypeError, ValueError):
+        return {"error": "conversation_id and limit must be integers", "code": -32602}
+
+    if not 1 <= limit <= max_limit:
+        return {"error": f"limit must be between 1 and {max_limit}", "code": -32602}
+
+    messages = await run_db(_recent_messages, conversation_id, current_user.id, limit)
+    if messages is None:
+        return {"error": "Conversation not found", "code": -32602}
+
+    return {
+        "message": "Messages fetched",
+        "messages": messages,
+    }
+
+
+@rpc.method("get_history", auth=True, stream=True, rate_class="read", timeout=60)
+async def get_history(params, current_user=None, stream=None):
+    """Scroll back through a conversation, newest first.
+
+    Up to CHAT_HISTORY_CHUNK_SIZE messages come back inline. Larger
+    backfills are read and sent one chunk at a time as ``stream``
+    notifications before the final result, so neither the DB session nor
+    the response ever holds the whole range.
+    """
+    chunk_size = current_app.config["CHAT_HISTORY_CHUNK_SIZE"]
+    max_limit = current_app.config["CHAT_HISTORY_STREAM_LIMIT"]
+    try:
+        conversation_id = _parse_int(params.get("conversation_id"))
+        before_id = params.get("before_id")
+        before_id = None if before_id is None else _parse_int(before_id)
+        limit = _parse_int(params.get("limit") or current_app.config["CHAT_HISTORY_PAGE_SIZE"])
+    except (TypeError, ValueError):
+        return {"error": "conversation_id, before_id and limit must be integers", "code": -32602}
+
+    if not 1 <= limit <= max_limit:
+        return {"error": f"limit must be between 1 and {max_limit}", "code": -32602}
+
+    if not await run_db(_is_member, conversation_id, current_user.id):
+        return {"error": "Conversation not found", "code": -32602}
+
+    if limit <= chunk_size or stream is None:
+        # One extra row tells us whether there is more to scroll back to
+        page_size = min(limit, chunk_size)
+        messages = await run_db(_history_page, conversation_id, before_id, page_size + 1)
+        has_more = len(messages) > page_size
+        messages = messages[:page_size]
+        return {
+            "message": "History fetched",
+            "messages": messages,
+            "next_before_id": messages[-1]["id"] if has_more and messages else None,
+        }
+
+    sent = 0
+    cursor = before_id
+    exhausted = False
+    while sent < limit:
+        size = min(chunk_size, limit - sent)
+        messages = await run_db(_history_page, conversation_id, cursor, size)
+        if messages:
+            await stream({"conversation_id": conversation_id, "messages": messages})
+            sent += len(messages)
+            cursor = int(messages[-1]["id"])
+        if len(messages) < size:
+            exhausted = True
+            break
+
+    if not exhausted:
+        exhausted = not await run_db(_history_page, conversation_id, cursor, 1)
+
+    return {
+        "message": "History streamed",
+        "streamed": True,
+        "count": sent,
+        "next_before_id": None if exhausted else str(cursor),
+    }
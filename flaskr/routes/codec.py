@@ -0,0 +1,143 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover - optional speedup
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional binary protocol
+    msgpack = None
+
+
+class JsonCodec:
+    """Encodes JSON-RPC frames straight to bytes.
+
+    The constant parts of the envelope are encoded once, so building a
+    response only serializes the id and the payload. Frames are sent as
+    text so existing JSON clients see no difference.
+    """
+
+    name = "json"
+    text = True
+    parse_error = "Invalid JSON"
+
+    _RESULT_HEAD = b'{"jsonrpc":"2.0","id":'
+    _RESULT_MID = b',"result":'
+    _ERROR_MID = b',"error":'
+    _NOTIFY_HEAD = b'{"jsonrpc":"2.0","method":'
+    _PARAMS_MID = b',"params":'
+    _TAIL = b"}"
+
+    def dumps(self, obj):
+        # Lone surrogates (e.g. "\ud800" from a client) have no UTF-8 form;
+        # backslashreplace writes them back as the same JSON escape
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8", "backslashreplace")
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def encode_result(self, request_id, result):
+        return b"".join((self._RESULT_HEAD, self.dumps(request_id), self._RESULT_MID, self.dumps(result), self._TAIL))
+
+    def encode_error(self, request_id, error):
+        return b"".join((self._RESULT_HEAD, self.dumps(request_id), self._ERROR_MID, self.dumps(error), self._TAIL))
+
+    def encode_notification(self, method, params):
+        return b"".join((self._NOTIFY_HEAD, self.dumps(method), self._PARAMS_MID, self.dumps(params), self._TAIL))
+
+    def encode_batch(self, responses):
+        return b"[" + b",".join(responses) + b"]"
+
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class UjsonCodec(JsonCodec):
+    name = "ujson"
+
+    def dumps(self, obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode("utf-8", "backslashreplace")
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+class MsgpackCodec:
+    """Same JSON-RPC envelopes as :class:`JsonCodec`, as MessagePack binary frames."""
+
+    name = "msgpack"
+    text = False
+    parse_error = "Invalid MessagePack"
+
+    def __init__(self):
+        pack = msgpack.packb
+        # A three-entry map whose first key/value pair never changes
+        self._head = b"\x83" + pack("jsonrpc") + pack("2.0") + pack("id")
+        self._result_key = pack("result")
+        self._error_key = pack("error")
+        self._notify_head = b"\x83" + pack("jsonrpc") + pack("2.0") + pack("method")
+        self._params_key = pack("params")
+        self._packer = msgpack.Packer()
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        if isinstance(data, str):
+            raise ValueError("MessagePack connections expect binary frames")
+        return msgpack.unpackb(data, raw=False)
+
+    def encode_result(self, request_id, result):
+        return b"".join((self._head, self.dumps(request_id), self._result_key, self.dumps(result)))
+
+    def encode_error(self, request_id, error):
+        return b"".join((self._head, self.dumps(request_id), self._error_key, self.dumps(error)))
+
+    def encode_notification(self, method, params):
+        return b"".join((self._notify_head, self.dumps(method), self._params_key, self.dumps(params)))
+
+    def encode_batch(self, responses):
+        return self._packer.pack_array_header(len(responses)) + b"".join(responses)
+
+
+CODECS = {"json": JsonCodec()}
+if ujson is not None:
+    CODECS["ujson"] = UjsonCodec()
+if orjson is not None:
+    CODECS["orjson"] = OrjsonCodec()
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+
+# WebSocket subprotocols a client can offer to pick its wire encoding, in
+# server preference order; clients that offer none get JSON
+SUBPROTOCOLS = {"jsonrpc.json": "auto"}
+if msgpack is not None:
+    SUBPROTOCOLS = {"jsonrpc.msgpack": "msgpack", **SUBPROTOCOLS}
+
+# Every codec signals bad input with a ValueError subclass
+DecodeError = ValueError
+
+
+def get_codec(name="auto"):
+    """Return the named codec, or the fastest installed JSON one for ``auto``."""
+    if name == "auto":
+        for candidate in ("orjson", "ujson", "json"):
+            if candidate in CODECS:
+                return CODECS[candidate]
+    if name not in CODECS:
+        raise ValueError(f"JSON codec '{name}' is not available")
+    return CODECS[name]
@@ -0,0 +1,118 @@
+import asyncio
+
+
+class RpcError(Exception):
+    def __init__(self, message, code=-32603, data=None):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+        self.data = data
+
+
+class RpcMethod:
+    __slots__ = ("name", "handler", "auth", "session", "stream", "rate_class", "timeout")
+
+    def __init__(self, name, handler, auth, session, stream, rate_class, timeout):
+        self.name = name
+        self.handler = handler
+        self.auth = auth
+        self.session = session
+        self.stream = stream
+        self.rate_class = rate_class
+        self.timeout = timeout
+
+
+class RpcContext:
+    """Everything middleware and handlers need to know about one request."""
+
+    __slots__ = (
+        "ws", "session", "request_id", "method", "params", "token", "stream",
+        "rpc", "current_user", "elapsed",
+    )
+
+    def __init__(self, ws, session, request_id, method, params, token, stream=None):
+        self.ws = ws
+        self.session = session
+        self.request_id = request_id
+        self.method = method
+        self.params = params
+        self.token = token
+        self.stream = stream
+        self.rpc = None
+        self.current_user = None
+        self.elapsed = None
+
+
+async def _invoke(ctx):
+    rpc = ctx.rpc
+    kwargs = {}
+    if rpc.auth:
+        kwargs["current_user"] = ctx.current_user
+    if rpc.session:
+        kwargs["session"] = ctx.session
+    if rpc.stream:
+        kwargs["stream"] = ctx.stream
+
+    call = rpc.handler(ctx.params, **kwargs)
+    if rpc.timeout:
+        return await asyncio.wait_for(call, rpc.timeout)
+    return await call
+
+
+class Dispatcher:
+    """Method registry plus a middleware chain wrapped around every call.
+
+    Middleware are ``async def mw(ctx, call_next)`` callables, run in the
+    order they were added; the chain is composed once, not per message.
+    """
+
+    def __init__(self):
+        self.methods = {}
+        self.middleware = []
+        self._chain = _invoke
+
+    def method(self, name, auth=False, session=False, stream=False, rate_class="default", timeout=None):
+        """Register an ``async def handler(params, ...)`` under ``name``.
+
+        ``auth`` handlers receive ``current_user``, ``session`` handlers the
+        per-connection session dict and ``stream`` handlers an async
+        ``stream(params)`` callable that sends partial results ahead of the
+        final response. ``timeout`` is in seconds.
+        """
+        def decorator(handler):
+            self.methods[name] = RpcMethod(name, handler, auth, session, stream, rate_class, timeout)
+            return handler
+        return decorator
+
+    def set_timeouts(self, default=None, overrides=None):
+        """Apply configured timeouts: ``overrides`` maps method name to
+        seconds, ``default`` covers methods registered without one."""
+        overrides = overrides or {}
+        for name, method in self.methods.items():
+            if name in overrides:
+                method.timeout = overrides[name]
+            elif method.timeout is None:
+                method.timeout = default
+
+    def use(self, middleware):
+        self.middleware.append(middleware)
+        chain = _invoke
+        for mw in reversed(self.middleware):
+            chain = _bind(mw, chain)
+        self._chain = chain
+
+    async def dispatch(self, ctx):
+        rpc = self.methods.get(ctx.method)
+        if rpc is None:
+            raise RpcError(f"Unknown method '{ctx.method}'", code=-32601)
+        ctx.rpc = rpc
+        return await self._chain(ctx)
+
+
+def _bind(middleware, call_next):
+    async def call(ctx):
+        return await middleware(ctx, call_next)
+    return call
+
+
+rpc = Dispatcher()
@@ -1,44 +1,102 @@
-import json
 import jwt
-from datetime import datetime, timedelta, timezone
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
 from flaskr.models import User
-from flaskr.extensions import db
-from functools import wraps
-
+from flaskr.extensions import db, tokens
+from flaskr.executors import run_db, run_cpu
+from flaskr.passwords import hash_password, verify_password, needs_rehash
+from flaskr.routes.dispatcher import rpc
+from flaskr.routes.fanout import fanout
+from flaskr.routes.principal import snapshot_user, set_principal, update_principal_user, invalidate_user, clear_principal
+
+
+# Hot lookups are built once with bind parameters. Each statement object
+# carries its cache key, so every call goes straight to SQLAlchemy's
+# compiled-statement cache instead of rebuilding and re-keying the query.
+_USER_BY_ID_AND_USERNAME = db.select(User).where(
+    User.id == db.bindparam("user_id"), User.username == db.bindparam("username")
+)
+_USER_BY_USERNAME = db.select(User).where(User.username == db.bindparam("username"))
+_USER_TAKEN = db.select(User.id).where(
+    db.or_(User.username == db.bindparam("username"), User.email == db.bindparam("email"))
+).limit(1)
+_DIRECTORY_COLUMNS = (User.id, User.username, User.name, User.email)
+_DIRECTORY_PAGE = (
+    db.select(*_DIRECTORY_COLUMNS)
+    .where(User.id > db.bindparam("after_id"))
+    .order_by(User.id)
+    .limit(db.bindparam("limit"))
+)
+_DIRECTORY_SEARCH_PAGE = (
+    db.select(*_DIRECTORY_COLUMNS)
+    .where(
+        User.id > db.bindparam("after_id"),
+        db.or_(
+            db.func.lower(User.username).like(db.bindparam("pattern"), escape="\\"),
+            db.func.lower(User.name).like(db.bindparam("pattern"), escape="\\"),
+        ),
+    )
+    .order_by(User.id)
+    .limit(db.bindparam("limit"))
+)
+
+
+def _find_user(user_id, username):
+    return snapshot_user(
+        db.session.scalars(_USER_BY_ID_AND_USERNAME, {"user_id": user_id, "username": username}).first()
+    )
+
+
+def _hash_settings():
+    return current_app.config["PASSWORD_HASH_METHOD"], current_app.config["PASSWORD_SALT_LENGTH"]
+
+
+def _user_exists(username, email):
+    return db.session.scalar(_USER_TAKEN, {"username": username, "email": email}) is not None
+
+
+def _register_user(name, username, email, password_hash):
+    new_user = User(name=name, username=username, email=email, password_hash=password_hash)
+    db.session.add(new_user)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    return {"username": new_user.username, "name": new_user.name}
 
-def requires_auth(func):
-    @wraps(func)
-    async def wrapper(params, token=None, current_user=None, *args, **kwargs):
-        if current_user:
-            kwargs["current_user"] = current_user
-            return await func(params, *args, **kwargs)
 
-        if not token:
-            return {"error": "Access token required"}
+def _get_credentials(username):
+    user = db.session.scalars(_USER_BY_USERNAME, {"username": username}).first()
+    if not user:
+        return None, None
+    return snapshot_user(user), user.password_hash
 
-        try:
-            decoded = jwt.decode(token, "secret", algorithms=["HS256"])
 
-            if decoded.get("type") != "access":
-                return {"error": "Invalid token type"}
+def _update_password_hash(user_id, password_hash):
+    User.query.filter_by(id=user_id).update({"password_hash": password_hash})
+    db.session.commit()
 
-            user_id = decoded.get("user_id")
-            user = User.query.get(user_id)
 
-            if not user:
-                return {"error": "User not found"}
+async def _verify_credentials(username, password):
+    user, password_hash = await run_db(_get_credentials, username)
+    if not user or not await run_cpu(verify_password, password_hash, password):
+        return None
 
-            kwargs["current_user"] = user
-            return await func(params, *args, **kwargs)
+    # Upgrade hashes made with old cost settings while we have the plaintext
+    method, salt_length = _hash_settings()
+    if needs_rehash(password_hash, method, salt_length):
+        new_hash = await run_cpu(hash_password, password, method, salt_length)
+        await run_db(_update_password_hash, user.id, new_hash)
+    return user
 
-        except jwt.ExpiredSignatureError:
-            return {"error": "Access token expired", "need_refresh": True}
-        except jwt.InvalidTokenError:
-            return {"error": "Invalid token"}
 
-    return wrapper
+@rpc.method("ping", rate_class="read")
+async def handle_ping(params):
+    return {"status": "ok"}
 
 
+@rpc.method("register", rate_class="auth", timeout=10)
 async def handle_register(params):
     name = params.get("name")
     username = params.get("username")
@@ -48,46 +106,39 @@ async def handle_register(params):
     if not name or not username or not email or not password:
         return {"error": "All fields required", "code": -32602}
 
-    if User.query.filter_by(username=username).first() or User.query.filter_by(email=email).first():
-        return {"error": "Username or email already exists", "code": -32602}    
+    if await run_db(_user_exists, username, email):
+        return {"error": "Username or email already exists", "code": -32602}
 
-    new_user = User(username=username, email=email)
-    new_user.set_password(password)
-    db.session.add(new_user)
-    db.session.commit()
+    password_hash = await run_cpu(hash_password, password, *_hash_settings())
+    new_user = await run_db(_register_user, name, username, email, password_hash)
+    if not new_user:
+        return {"error": "Username or email already exists", "code": -32602}    
 
     return {
         "message": "Registration successful",
-        "username": new_user.username,
-        "name": new_user.name
+        "username": new_user["username"],
+        "name": new_user["name"]
     }
 
 
-async def handle_login(params):
+@rpc.method("login", session=True, rate_class="auth", timeout=10)
+async def handle_login(params, session=None):
     username = params.get("username")
     password = params.get("password")
 
     if not username or not password:
         return {"error": "Username and password required"}
 
-    user = User.query.filter_by(username=username).first()
+    # login changes the session, so a connection runs one at a time; the
+    # "auth" rate limit bounds how often each socket and user can hash
+    session = session if session is not None else {}
+    user = await _verify_credentials(username, password)
 
-    if user and user.check_password(password):
-        access_payload = {
-            "user_id": user.id,
-            "username": user.username,
-            "type": "access",
-            "exp": datetime.now(timezone.utc) + timedelta(hours=1)
-        }
-        access_token = jwt.encode(access_payload, "secret", algorithm="HS256")
+    if user:
+        access_token, access_payload = tokens.issue(user, "access")
+        refresh_token, _ = tokens.issue(user, "refresh")
 
-        refresh_payload = {
-            "user_id": user.id,
-            "username": user.username,
-            "type": "refresh",
-            "exp": datetime.now(timezone.utc) + timedelta(days=7)
-        }
-        refresh_token = jwt.encode(refresh_payload, "secret", algorithm="HS256")
+        set_principal(session, access_token, access_payload, user)
 
         return {
             "message": "Login successful",
@@ -100,13 +151,14 @@ async def handle_login(params):
         return {"error": "Invalid credentials", "code": -32000}
     
 
-async def handle_refresh_token(params):
+@rpc.method("refresh_token", session=True, rate_class="auth")
+async def handle_refresh_token(params, session=None):
     refresh_token = params.get("refresh_token")
     if not refresh_token:
         return {"error": "Refresh token required"}
 
     try:
-        decoded = jwt.decode(refresh_token, "secret", algorithms=["HS256"])
+        decoded = tokens.verify(refresh_token)
 
         if decoded.get("type") != "refresh":
             return {"error": "Invalid token type"}
@@ -114,17 +166,14 @@ async def handle_refresh_token(params):
         user_id = decoded.get("user_id")
         username = decoded.get("username")
 
-        user = User.query.filter_by(id=user_id, username=username).first()
+        user = await run_db(_find_user, user_id, username)
         if not user:
             return {"error": "User not found"}
 
-        new_access_payload = {
-            "user_id": user.id,
-            "username": user.username,
-            "type": "access",
-            "exp": datetime.now(timezone.utc) + timedelta(minutes=60)
-        }
-        new_access_token = jwt.encode(new_access_payload, "secret", algorithm="HS256")
+        new_access_token, new_access_payload = tokens.issue(user, "access")
+
+        if session is not None:
+            set_principal(session, new_access_token, new_access_payload, user)
 
         return {
             "message": "New access token issued",
@@ -139,23 +188,27 @@ async def handle_refresh_token(params):
         return {"error": "Invalid refresh token"}
 
 
-async def handle_auth_with_token(params):
+@rpc.method("auth_with_token", session=True, rate_class="auth")
+async def handle_auth_with_token(params, session=None):
     token = params.get("access_token")
     if not token:
         return {"error": "Access token required"}
 
     try:
-        decoded = jwt.decode(token, "secret", algorithms=["HS256"])
+        decoded = tokens.verify(token)
         if decoded.get("type") != "access":
             return {"error": "Invalid token type"}
 
         user_id = decoded.get("user_id")
         username = decoded.get("username")
 
-        user = User.query.filter_by(id=user_id, username=username).first()
+        user = await run_db(_find_user, user_id, username)
         if not user:
             return {"error": "User not found"}
 
+        if session is not None:
+            set_principal(session, token, decoded, user)
+
         return {
             "message": "Authenticated successfully",
             "user_id": user.id,
@@ -168,8 +221,33 @@ async def handle_auth_with_token(params):
         return {"error": "Invalid token"}
 
 
+@rpc.method("logout", session=True, rate_class="auth")
+async def handle_logout(params, session=None):
+    session = session if session is not None else {}
+    access_token = params.get("access_token") or session.get("access_token")
+    refresh_token = params.get("refresh_token")
+    if not access_token and not refresh_token:
+        return {"error": "Access token required"}
 
-@requires_auth
+    for token in (access_token, refresh_token):
+        if token:
+            revoked = tokens.revoke(token)
+            if revoked is not None:
+                # Other worker processes verify tokens against their own caches
+                fanout.broadcast("token_revoked", revoked)
+    clear_principal(session)
+
+    return {"message": "Logged out"}
+
+
+def _remote_token_revoked(user_ids, params):
+    tokens.revoke_digest(params["digest"], params["exp"])
+
+
+fanout.routes["token_revoked"] = _remote_token_revoked
+
+
+@rpc.method("get_user_details", auth=True, rate_class="read")
 async def get_user_details(params, current_user=None):
     return {
         "message": "User details fetched",
@@ -178,35 +256,75 @@ async def get_user_details(params, current_user=None):
     }
 
 
-@requires_auth
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _list_users(after_id, limit, prefix):
+    # Select only the directory columns; never load password hashes here.
+    # One extra row tells us whether another page exists
+    if prefix:
+        rows = db.session.execute(_DIRECTORY_SEARCH_PAGE, {
+            "after_id": after_id, "limit": limit + 1, "pattern": _escape_like(prefix.lower()) + "%",
+        }).all()
+    else:
+        rows = db.session.execute(_DIRECTORY_PAGE, {"after_id": after_id, "limit": limit + 1}).all()
+    return [{"id": row.id, "username": row.username, "name": row.name, "email": row.email} for row in rows]
+
+
+def _set_profile_image(user_id, image_url):
+    user = User.query.get(user_id)
+    user.profile_image = image_url
+    db.session.commit()
+    return snapshot_user(user)
+
+
+@rpc.method("get_all_users", auth=True, rate_class="read", timeout=10)
 async def get_all_users(params, current_user=None):
-    users = User.query.all()
-    user_list = [{"id": user.id, "username": user.username, "name": user.name, "email": user.email} for user in users]
+    max_limit = current_app.config["USER_DIRECTORY_MAX_PAGE_SIZE"]
+    try:
+        after_id = int(params.get("after_id") or 0)
+        limit = int(params.get("limit") or current_app.config["USER_DIRECTORY_PAGE_SIZE"])
+    except (TypeError, ValueError):
+        return {"error": "after_id and limit must be integers", "code": -32602}
+
+    if after_id < 0 or not 1 <= limit <= max_limit:
+        return {"error": f"limit must be between 1 and {max_limit}", "code": -32602}
+
+    prefix = params.get("search")
+    if prefix is not None and not isinstance(prefix, str):
+        return {"error": "search must be a string", "code": -32602}
+
+    user_list = await run_db(_list_users, after_id, limit, prefix)
+    has_more = len(user_list) > limit
+    user_list = user_list[:limit]
     return {
         "message": "All users fetched",
         "users": user_list,
-        
+        "next_after_id": user_list[-1]["id"] if has_more else None,
     }
 
-@requires_auth
-async def handle_upload_profile_picture(params, current_user=None):
+@rpc.method("upload_profile_picture", auth=True, session=True, rate_class="write")
+async def handle_upload_profile_picture(params, current_user=None, session=None):
     image_url = params.get("image_url")
 
     if not image_url:
         return {"error": "Image URL required"}
 
-    # Update user profile image
-    current_user.profile_image = image_url
-    db.session.commit()
+    # Update user profile image and drop cached snapshots on other connections
+    user = await run_db(_set_profile_image, current_user.id, image_url)
+    invalidate_user(user.id)
+    if session is not None:
+        update_principal_user(session, user)
 
     return {
         "message": "Profile picture updated successfully",
-        "profile_image": current_user.profile_image,
+        "profile_image": user.profile_image,
         "user_id": current_user.id,
         "username": current_user.username
     }
 
-@requires_auth
+@rpc.method("get_profile_picture", auth=True, rate_class="read")
 async def get_profile_picture(params, current_user=None):
     if not current_user.profile_image:
         return {
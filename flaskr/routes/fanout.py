@@ -0,0 +1,139 @@
+import asyncio
+from collections import defaultdict
+from flaskr.routes.outbound import outbox_for
+
+
+class FanoutIndex:
+    """Maps user ids to their live, authenticated sockets in this process.
+
+    Delivering to a conversation costs one dict lookup per member and one
+    encode per wire codec in use, instead of a scan of every connection.
+    With a ``backplane`` attached, users connected to other processes are
+    reached through it and presence changes here are announced to them.
+
+    ``presence_listeners`` are called with a user id whenever that user
+    may have come online or gone offline, here or on another node.
+    ``routes`` maps notification methods arriving from the backplane to a
+    local ``handler(user_ids, params)`` instead of sending them as-is.
+    """
+
+    def __init__(self):
+        self._sockets = defaultdict(dict)  # user_id -> {ws: codec}
+        self._owners = {}  # ws -> user_id
+        self._tasks = set()
+        self.backplane = None
+        self.presence_listeners = []
+        self.routes = {}
+
+    def add(self, user_id, ws, codec):
+        previous = self._owners.get(ws)
+        if previous is not None and previous != user_id:
+            self.discard(ws)
+        came_online = user_id not in self._sockets
+        if came_online and self.backplane is not None:
+            self.backplane.user_online(user_id)
+        self._sockets[user_id][ws] = codec
+        self._owners[ws] = user_id
+        if came_online:
+            self.presence_changed(user_id)
+
+    def discard(self, ws):
+        user_id = self._owners.pop(ws, None)
+        if user_id is None:
+            return
+        sockets = self._sockets.get(user_id)
+        if sockets is not None:
+            sockets.pop(ws, None)
+            if not sockets:
+                del self._sockets[user_id]
+                if self.backplane is not None:
+                    self.backplane.user_offline(user_id)
+                self.presence_changed(user_id)
+
+    def presence_changed(self, user_id):
+        for listener in self.presence_listeners:
+            listener(user_id)
+
+    def is_online(self, user_id):
+        if user_id in self._sockets:
+            return True
+        return self.backplane is not None and self.backplane.is_online(user_id)
+
+    def online_users(self):
+        return list(self._sockets)
+
+    def owner_of(self, ws):
+        return self._owners.get(ws)
+
+    def codec_for(self, ws):
+        user_id = self._owners.get(ws)
+        if user_id is None:
+            return None
+        return self._sockets[user_id].get(ws)
+
+    def sockets_for(self, user_ids, exclude=None):
+        for user_id in user_ids:
+            for ws, codec in self._sockets.get(user_id, {}).items():
+                if ws is not exclude:
+                    yield ws, codec
+
+    async def publish(self, user_ids, method, params, exclude=None, timeout=5):
+        """Send a notification to every online socket of ``user_ids``.
+
+        Frames are handed to each socket's outbox, which drops them (or
+        drops the client) rather than wait on a slow consumer. Sockets
+        without an outbox are sent to directly, each bounded by
+        ``timeout`` seconds.
+        """
+        frames = {}
+        sends = []
+        for ws, codec in self.sockets_for(user_ids, exclude):
+            frame = frames.get(codec.name)
+            if frame is None:
+                frame = frames[codec.name] = codec.encode_notification(method, params)
+            sends.append(_send_bounded(ws, frame, codec.text, timeout))
+        if sends:
+            await asyncio.gather(*sends, return_exceptions=True)
+        return len(sends)
+
+    def publish_soon(self, user_ids, method, params, exclude=None, timeout=5, forward=True, coalesce_key=None):
+        """Fire-and-forget :meth:`publish`, keeping a reference until it finishes.
+
+        Unless ``forward`` is False (the event came in from the backplane),
+        recipients online on other nodes are handed to the backplane too.
+        """
+        if forward and self.backplane is not None:
+            self.backplane.publish(user_ids, method, params, coalesce_key)
+        task = asyncio.create_task(self.publish(user_ids, method, params, exclude, timeout))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def broadcast(self, method, params):
+        """Send an event to the ``routes`` handler of every other node.
+
+        Safe to call from HTTP worker threads. Without a backplane there
+        are no other nodes, and this does nothing.
+        """
+        backplane = self.backplane
+        if backplane is not None:
+            backplane.broadcast(method, params)
+
+    def deliver_remote(self, user_ids, method, params):
+        """Hand an event received from the backplane to its local recipients."""
+        handler = self.routes.get(method)
+        if handler is not None:
+            handler(user_ids, params)
+        elif user_ids is not None:
+            self.publish_soon(user_ids, method, params, forward=False)
+
+
+async def _send_bounded(ws, frame, text, timeout):
+    outbox = outbox_for(ws)
+    if outbox is not None:
+        outbox.offer(frame)
+    else:
+        await asyncio.wait_for(ws.send(frame, text=text), timeout)
+
+
+fanout = FanoutIndex()
@@ -1,30 +1,133 @@
 import asyncio
+import logging
+import signal
+from functools import partial
 import websockets
-from flaskr import create_app
+from flaskr import get_app
 from flaskr.extensions import db
-from flaskr.routes.ws_routes import handle_ws_message
+from flaskr.executors import shutdown_executors
+from flaskr.logs import logs
+from flaskr.metrics import metrics
+from flaskr.routes.backplane import create_backplane
+from flaskr.routes.codec import SUBPROTOCOLS
+from flaskr.routes.fanout import fanout
+from flaskr.routes.message_writer import message_writer
+from flaskr.routes.outbound import stats as outbound_stats
+from flaskr.routes.presence import presence
+from flaskr.routes.dispatcher import rpc
+from flaskr.routes.ws_routes import ConnectionSlots, RequestPipeline, admit_connection, new_session, select_subprotocol
+
+log = logging.getLogger(__name__)
 
 # Store per-connection session context (e.g. authenticated user id, tokens, etc.)
 connected_clients = {}
+# Counted from admission, so WS_MAX_CONNECTIONS holds during handshake bursts
+connection_slots = ConnectionSlots()
+
+app = get_app()
 
-app = create_app()
-app.app_context().push()
+metrics.gauge("ws_connections", "Open WebSocket connections.", lambda: len(connected_clients))
+metrics.gauge("ws_online_users", "Users with at least one authenticated socket here.", lambda: len(fanout.online_users()))
+metrics.gauge("chat_write_queue", "Chat messages accepted but not yet committed.", lambda: message_writer.queued)
+metrics.gauge("ws_outbound_queued_bytes", "Bytes waiting in outbound queues.",
+              lambda: outbound_stats.snapshot()["queued_bytes"])
+metrics.gauge("ws_outbound_dropped_frames_total", "Notifications dropped for slow consumers.",
+              lambda: outbound_stats.dropped_frames, kind="counter")
+metrics.gauge("ws_outbound_evicted_connections_total", "Slow consumers disconnected.",
+              lambda: outbound_stats.evicted_connections, kind="counter")
+metrics.gauge("log_records_dropped_total", "Log records dropped because the log queue was full.",
+              lambda: logs.dropped, kind="counter")
 
 
 async def ws_handler(ws):
-    connected_clients[ws] = {"user_id": None, "access_token": None}
-    print("✅ Client connected")
+    connected_clients[ws] = new_session(ws)
+    requests = RequestPipeline(ws, connected_clients, app.config["WS_MAX_IN_FLIGHT"])
+    log.info("Client connected")
     try:
         async for message in ws:
-            print("Received:", message)
-            await handle_ws_message(ws, message, connected_clients)
+            await requests.submit(message)
     except websockets.ConnectionClosed:
-        print("❌ Client disconnected")
+        log.info("Client disconnected")
+    finally:
+        # Nobody is left to read the responses
+        await requests.cancel()
+        session = connected_clients.pop(ws, None)
+        if session is not None:
+            session["outbox"].close()
+        # Drops the user to offline (and clears their typing) if this was their last socket
+        fanout.discard(ws)
+        presence.discard(ws)
+
+
+def _admit(connection, request, max_connections):
+    return admit_connection(connection, request, connection_slots, max_connections)
+
+
+async def start_services():
+    """Start everything WebSocket handling needs apart from the listener.
+
+    Returns the backplane to hand to :func:`stop_services`.
+    """
+    rpc.set_timeouts(app.config["RPC_DEFAULT_TIMEOUT"], app.config["RPC_METHOD_TIMEOUTS"])
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, logs.toggle_debug)
+    except (NotImplementedError, RuntimeError, ValueError):
+        pass  # no signals here (Windows, or not the main thread)
+    backplane = create_backplane(app)
+    await backplane.start(fanout)
+    fanout.backplane = backplane
+    message_writer.start()
+    return backplane
+
+
+async def stop_services(backplane):
+    # Persist queued chat messages before the DB threads go away
+    await message_writer.close()
+    fanout.backplane = None
+    await backplane.close()
+    shutdown_executors()
+
+
+async def run_relay():
+    """Keep a backplane up in a process that serves HTTP but no sockets.
+
+    With ``run.py --legacy --workers N`` the sockets live in worker
+    processes; this carries the HTTP side's profile changes to them.
+    """
+    backplane = create_backplane(app)
+    await backplane.start(fanout)
+    fanout.backplane = backplane
+    try:
+        await asyncio.Future()
     finally:
-        connected_clients.pop(ws, None)
+        fanout.backplane = None
+        await backplane.close()
+
 
+async def start_websocket_server(host="0.0.0.0", port=8765, reuse_port=False, stop=None, ready=None):
+    """Serve until ``stop`` (an awaitable) completes, or forever.
 
-async def start_websocket_server():
-    async with websockets.serve(ws_handler, "0.0.0.0", 8765):
-        print("🚀 WebSocket server running on ws://0.0.0.0:8765")
-        await asyncio.Future()  # Keep running forever
+    ``reuse_port`` lets several worker processes bind the same port;
+    ``ready``, an asyncio.Event, is set once the server is listening.
+    """
+    backplane = await start_services()
+    try:
+        async with websockets.serve(
+            ws_handler,
+            host,
+            port,
+            subprotocols=list(SUBPROTOCOLS),
+            select_subprotocol=select_subprotocol,
+            process_request=partial(
+                _admit,
+                max_connections=app.config["WS_MAX_CONNECTIONS"],
+            ),
+            reuse_port=reuse_port,
+        ):
+            log.info(f"WebSocket server running on ws://{host}:{port}")
+            if ready is not None:
+                ready.set()
+            # Leaving the block closes open connections with 1001 (going away)
+            await (stop if stop is not None else asyncio.Future())
+    finally:
+        await stop_services(backplane)
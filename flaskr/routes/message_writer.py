@@ -0,0 +1,192 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from sqlalchemy.exc import DataError, IntegrityError
+from flaskr.models import Message
+from flaskr.extensions import db
+from flaskr.executors import run_db
+from flaskr.ids import IdGenerator
+
+log = logging.getLogger(__name__)
+
+# Acknowledge once the batch holding the message has committed
+ACK_AFTER_COMMIT = "commit"
+# Acknowledge as soon as the message is queued; a crash can lose the
+# last CHAT_WRITE_FLUSH_MS worth of messages
+ACK_AFTER_ENQUEUE = "enqueue"
+
+# Longest wait between attempts at a failing batch, in seconds
+MAX_RETRY_DELAY = 5
+
+# Errors that blame the rows (a sender deleted meanwhile, a value too
+# long) rather than the database; retrying the same row cannot help
+ROW_ERRORS = (IntegrityError, DataError)
+
+
+def _insert_messages(rows):
+    db.session.execute(db.insert(Message), rows)
+    db.session.commit()
+
+
+class MessageWriter:
+    """Write-behind queue that persists chat messages in batches.
+
+    Messages get their id and timestamp when submitted, then are inserted
+    with one multi-row INSERT and one commit per batch. A batch is flushed
+    when it reaches ``batch_size`` rows or ``flush_interval`` seconds after
+    its first row, whichever comes first. Only one flush runs at a time so
+    rows reach the DB in id order.
+
+    A batch the DB rejects because of its rows is split in half until the
+    offending rows are found; only those are dropped. Other failures are
+    retried with exponential backoff, up to ``max_attempts`` times.
+    """
+
+    def __init__(self, app=None):
+        self._pending = []
+        self._task = None
+        self._closing = False
+        self._has_items = None
+        self._full = None
+        self._space = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.mode = app.config["CHAT_WRITE_MODE"]
+        if self.mode not in (ACK_AFTER_COMMIT, ACK_AFTER_ENQUEUE):
+            raise ValueError(f"Unknown CHAT_WRITE_MODE '{self.mode}'")
+        self.batch_size = app.config["CHAT_WRITE_BATCH_SIZE"]
+        self.flush_interval = app.config["CHAT_WRITE_FLUSH_MS"] / 1000
+        self.max_pending = app.config["CHAT_WRITE_QUEUE_LIMIT"]
+        self.max_attempts = app.config["CHAT_WRITE_MAX_ATTEMPTS"]
+        self.retry_delay = app.config["CHAT_WRITE_RETRY_MS"] / 1000
+        self.ids = IdGenerator(app.config["NODE_ID"])
+
+    @property
+    def queued(self):
+        """Messages accepted but not yet committed."""
+        return len(self._pending)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._closing = False
+            self._has_items = asyncio.Event()
+            self._full = asyncio.Event()
+            self._space = asyncio.Event()
+            self._space.set()
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, conversation_id, sender_id, body):
+        """Queue a message and return its row as a dict once acknowledged."""
+        self.start()
+        while len(self._pending) >= self.max_pending:
+            self._space.clear()
+            await self._space.wait()
+
+        row = {
+            "id": self.ids.next_id(),
+            "conversation_id": conversation_id,
+            "sender_id": sender_id,
+            "body": body,
+            # Naive UTC, so the stored value does not depend on the DB session's time zone
+            "created_at": datetime.now(timezone.utc).replace(tzinfo=None),
+        }
+        committed = asyncio.get_running_loop().create_future() if self.mode == ACK_AFTER_COMMIT else None
+        self._pending.append((row, committed, 0))
+        self._has_items.set()
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+
+        if committed is not None:
+            await committed
+        return row
+
+    async def _run(self):
+        while True:
+            await self._has_items.wait()
+            if len(self._pending) < self.batch_size and not self._closing:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            if len(self._pending) < self.batch_size:
+                self._full.clear()
+            if not self._pending:
+                self._has_items.clear()
+            self._space.set()
+
+            if batch:
+                await self._flush(batch)
+            if self._closing and not self._pending:
+                return
+
+    async def _flush(self, batch):
+        failed, error = await self._write(batch)
+        if not failed:
+            return
+        retry = [(row, committed, attempts + 1) for row, committed, attempts in failed if attempts + 1 < self.max_attempts]
+        dropped = len(failed) - len(retry)
+        log.error(f"Failed to persist {len(failed)} messages ({dropped} dropped): {error}")
+        for row, committed, attempts in failed:
+            if attempts + 1 >= self.max_attempts:
+                _settle(committed, error)
+        if retry:
+            # Hold the queue back while the DB recovers; submit() pushes back once it fills
+            await asyncio.sleep(min(self.retry_delay * 2 ** (retry[0][2] - 1), MAX_RETRY_DELAY))
+            self._pending[:0] = retry
+            self._has_items.set()
+
+    async def _write(self, batch):
+        """Insert ``batch``, dropping rows the DB rejects.
+
+        Returns the entries still to retry after any other failure, in
+        order, with the error that stopped them.
+        """
+        try:
+            await run_db(_insert_messages, [row for row, _, _ in batch])
+        except ROW_ERRORS as e:
+            if len(batch) == 1:
+                row, committed, _ = batch[0]
+                log.error(f"Dropping message {row['id']} for conversation {row['conversation_id']}: {e}")
+                _settle(committed, e)
+                return [], None
+            half = len(batch) // 2
+            failed, error = await self._write(batch[:half])
+            if failed:
+                return failed + batch[half:], error
+            return await self._write(batch[half:])
+        except Exception as e:
+            return batch, e
+
+        for _, committed, _ in batch:
+            _settle(committed)
+        return [], None
+
+    async def close(self):
+        """Flush everything still queued, then stop the background task."""
+        if self._task is None:
+            return
+        self._closing = True
+        self._has_items.set()
+        self._full.set()
+        try:
+            await self._task
+        finally:
+            self._task = None
+
+
+def _settle(committed, error=None):
+    # Enqueue-mode rows have no future; their senders were acked already
+    if committed is None or committed.done():
+        return
+    if error is None:
+        committed.set_result(None)
+    else:
+        committed.set_exception(error)
+
+
+message_writer = MessageWriter()
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+import jwt
+from flask import current_app
+from flaskr.models import User
+from flaskr.extensions import tokens
+from flaskr.executors import run_db
+from flaskr.metrics import metrics
+from flaskr.routes.dispatcher import RpcError
+from flaskr.routes.principal import snapshot_user, get_principal, is_stale, set_principal, update_principal_user
+
+log = logging.getLogger(__name__)
+
+
+async def error_middleware(ctx, call_next):
+    """Map handler error dicts and exceptions onto JSON-RPC errors."""
+    try:
+        result = await call_next(ctx)
+    except RpcError:
+        raise
+    except asyncio.TimeoutError:
+        raise RpcError(f"Method '{ctx.method}' timed out", code=-32000)
+    except Exception as e:
+        raise RpcError(f"Internal error: {str(e)}", code=-32603)
+
+    if isinstance(result, dict) and "error" in result:
+        data = {k: v for k, v in result.items() if k not in ("error", "code")}
+        raise RpcError(result["error"], code=result.get("code", -32603), data=data or None)
+    return result
+
+
+async def timing_middleware(ctx, call_next):
+    started = time.perf_counter()
+    token = metrics.start_request()
+    try:
+        return await call_next(ctx)
+    finally:
+        ctx.elapsed = time.perf_counter() - started
+        metrics.end_request(ctx.method, ctx.elapsed, token)
+        if ctx.elapsed * 1000 >= current_app.config["RPC_SLOW_CALL_MS"]:
+            log.warning(
+                f"Slow call '{ctx.method}' took {ctx.elapsed * 1000:.1f} ms",
+                extra={"fields": {"method": ctx.method, "elapsed_ms": round(ctx.elapsed * 1000, 1)}},
+            )
+
+
+def _load_user(user_id):
+    return snapshot_user(User.query.get(user_id))
+
+
+async def _get_session_user(session):
+    principal = get_principal(session)
+    if not principal:
+        return None
+    if tokens.is_revoked(session["access_token"]):
+        session.pop("principal", None)
+        return None
+    # Only hits the DB after this user's profile changed on some connection
+    if is_stale(principal):
+        user = await run_db(_load_user, principal["user"].id)
+        if not user:
+            session.pop("principal", None)
+            return None
+        update_principal_user(session, user)
+    return principal["user"]
+
+
+async def auth_middleware(ctx, call_next):
+    """Resolve ``current_user`` for methods registered with ``auth=True``."""
+    if not ctx.rpc.auth:
+        return await call_next(ctx)
+
+    user = await _get_session_user(ctx.session)
+    if user is None:
+        if not ctx.token:
+            return {"error": "Access token required"}
+
+        try:
+            decoded = tokens.verify(ctx.token)
+        except jwt.ExpiredSignatureError:
+            return {"error": "Access token expired", "need_refresh": True}
+        except jwt.InvalidTokenError:
+            return {"error": "Invalid token"}
+
+        if decoded.get("type") != "access":
+            return {"error": "Invalid token type"}
+
+        user = await run_db(_load_user, decoded.get("user_id"))
+        if not user:
+            return {"error": "User not found"}
+
+        # Later frames on this connection can skip the token and the query
+        set_principal(ctx.session, ctx.token, decoded, user)
+
+    ctx.current_user = user
+    return await call_next(ctx)
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+from collections import deque
+import websockets
+from flaskr.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+DROP = "drop"
+DISCONNECT = "disconnect"
+
+# Close code for evicted slow consumers: "try again later"
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# ws -> Outbox for every open connection
+_outboxes = {}
+
+
+class OutboundStats:
+    """Process-wide counters; plain ints, only changed from the event loop."""
+
+    def __init__(self):
+        self.dropped_frames = 0
+        self.evicted_connections = 0
+        self.coalesced_frames = 0
+        self.peak_queued_bytes = 0
+
+    def snapshot(self):
+        # May run on an HTTP thread (/metrics) while the loop adds and removes outboxes
+        outboxes = list(_outboxes.values())
+        return {
+            "connections": len(outboxes),
+            "queued_frames": sum(outbox.queued_frames for outbox in outboxes),
+            "queued_bytes": sum(outbox.queued_bytes for outbox in outboxes),
+            "peak_queued_bytes": self.peak_queued_bytes,
+            "dropped_frames": self.dropped_frames,
+            "evicted_connections": self.evicted_connections,
+            "coalesced_frames": self.coalesced_frames,
+        }
+
+
+stats = OutboundStats()
+
+
+class Outbox:
+    """Bounded queue of encoded frames for one connection, drained by a writer task.
+
+    Responses go through :meth:`put`, which waits while the queue is above
+    ``high_water`` bytes until it drains below ``low_water``; that stops
+    the connection's own request loop, not anyone else's. Notifications
+    (fan-out, presence) go through :meth:`offer`, which never waits: above
+    the high watermark the ``policy`` either drops them until the queue is
+    back under the low watermark, or disconnects the client.
+
+    With ``coalesce`` on, frames that queued up while the socket was busy
+    are sent as one JSON-RPC batch frame of at most ``coalesce_bytes``.
+    A batch response is queued as its list of encoded responses, so it is
+    merged into that frame element by element rather than nested.
+    """
+
+    def __init__(self, ws, codec, high_water, low_water, policy=DROP, coalesce=False, coalesce_bytes=65536):
+        if policy not in (DROP, DISCONNECT):
+            raise ValueError(f"Unknown slow consumer policy '{policy}'")
+        self.ws = ws
+        self.codec = codec
+        self.high_water = high_water
+        self.low_water = low_water
+        self.policy = policy
+        self.coalesce = coalesce
+        self.coalesce_bytes = coalesce_bytes
+        self.queued_bytes = 0
+        self._frames = deque()
+        self._shedding = False
+        self._closed = False
+        self._has_frames = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._writer = asyncio.create_task(self._run())
+        _outboxes[ws] = self
+
+    @property
+    def queued_frames(self):
+        return len(self._frames)
+
+    def _append(self, frame):
+        size = _size(frame)
+        metrics.frame("out", size)
+        self._frames.append(frame)
+        self.queued_bytes += size
+        if self.queued_bytes > stats.peak_queued_bytes:
+            stats.peak_queued_bytes = self.queued_bytes
+        if self.queued_bytes > self.high_water:
+            self._writable.clear()
+        self._has_frames.set()
+
+    async def put(self, frame):
+        """Queue a frame that must be delivered, waiting out backpressure."""
+        while not self._writable.is_set() and not self._closed:
+            await self._writable.wait()
+        if not self._closed:
+            self._append(frame)
+
+    def offer(self, frame):
+        """Queue a frame if the client keeps up; returns False if it was not queued."""
+        if self._closed:
+            return False
+        if self._shedding or self.queued_bytes + len(frame) > self.high_water:
+            if self.policy == DISCONNECT:
+                self._evict()
+                return False
+            self._shedding = True
+            stats.dropped_frames += 1
+            return False
+        self._append(frame)
+        return True
+
+    def _evict(self):
+        stats.evicted_connections += 1
+        log.warning(f"Disconnecting slow consumer ({self.queued_bytes} bytes queued)")
+        self.close()
+        asyncio.create_task(self.ws.close(SLOW_CONSUMER_CLOSE_CODE, "slow consumer"))
+
+    def _take(self):
+        frame = self._frames.popleft()
+        size = _size(frame)
+        batch = isinstance(frame, list)
+        if self.coalesce and self._frames:
+            responses = list(frame) if batch else [frame]
+            while self._frames and size + _size(self._frames[0]) <= self.coalesce_bytes:
+                queued = self._frames.popleft()
+                size += _size(queued)
+                if isinstance(queued, list):
+                    responses.extend(queued)
+                else:
+                    responses.append(queued)
+                stats.coalesced_frames += 1
+            if len(responses) > 1:
+                return self.codec.encode_batch(responses), size
+        if batch:
+            frame = self.codec.encode_batch(frame)
+        return frame, size
+
+    async def _run(self):
+        try:
+            while True:
+                await self._has_frames.wait()
+                while self._frames:
+                    frame, size = self._take()
+                    # Counted until sent: ws.send waits while the socket buffer is full
+                    await self.ws.send(frame, text=self.codec.text)
+                    self.queued_bytes -= size
+                    if self.queued_bytes <= self.low_water:
+                        self._shedding = False
+                        self._writable.set()
+                self._has_frames.clear()
+        except websockets.ConnectionClosed:
+            self.close()
+        except Exception:
+            log.exception("Outbound writer failed")
+            self.close()
+
+    def close(self):
+        self._closed = True
+        self._writable.set()  # release anyone waiting in put()
+        _outboxes.pop(self.ws, None)
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
+
+
+def _size(frame):
+    # Batch responses are queued as lists of encoded responses
+    return sum(map(len, frame)) if isinstance(frame, list) else len(frame)
+
+
+def outbox_for(ws):
+    return _outboxes.get(ws)
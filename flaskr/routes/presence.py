@@ -0,0 +1,254 @@
+import asyncio
+import math
+import time
+from collections import defaultdict
+from flask import current_app
+from flaskr.routes.dispatcher import rpc
+from flaskr.routes.fanout import fanout, _send_bounded
+from flaskr.routes.chat import _cached_member_ids, _parse_int
+
+ONLINE = "online"
+OFFLINE = "offline"
+
+
+class PresenceHub:
+    """Online/offline and typing state, delivered as per-socket digests.
+
+    Nothing is sent when state changes. Changes are queued per recipient
+    socket, keyed by (user) or (conversation, user) so repeats overwrite
+    each other, and every ``flush_interval`` seconds each socket with
+    pending changes gets one ``presence`` notification. A user typing in
+    a busy conversation therefore costs each watcher at most one frame
+    per interval, however fast the keystrokes arrive.
+
+    Everything lives in memory: online state comes from ``fanout`` (and
+    its backplane), typing state expires after ``typing_ttl`` seconds
+    unless refreshed.
+    """
+
+    def __init__(self, app=None):
+        self._watchers = defaultdict(set)  # watched user_id -> {ws}
+        self._watching = defaultdict(set)  # ws -> {watched user_id}
+        self._status = {}  # watched user_id -> last status announced
+        self._typing = {}  # (conversation_id, user_id) -> (expires at, recipient ids, forward)
+        self._typing_users = defaultdict(set)  # conversation_id -> {user_id in _typing}
+        self._pending = {}  # ws -> {"users": {user_id: status}, "typing": {(conv, user): bool}}
+        self._task = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.flush_interval = app.config["PRESENCE_FLUSH_MS"] / 1000
+        self.typing_ttl = app.config["PRESENCE_TYPING_TTL"]
+        if self.user_changed not in fanout.presence_listeners:
+            fanout.presence_listeners.append(self.user_changed)
+        fanout.routes["typing"] = self._remote_typing
+
+    # -- queries ----------------------------------------------------------
+
+    def status(self, user_id):
+        return ONLINE if fanout.is_online(user_id) else OFFLINE
+
+    def typing_in(self, conversation_id):
+        now = time.monotonic()
+        return [
+            user_id for user_id in self._typing_users.get(conversation_id, ())
+            if self._typing[conversation_id, user_id][0] > now
+        ]
+
+    # -- watching ---------------------------------------------------------
+
+    def watch(self, ws, user_ids):
+        """Replace the set of users ``ws`` gets presence updates for."""
+        self.unwatch(ws)
+        for user_id in user_ids:
+            self._watchers[user_id].add(ws)
+            self._status.setdefault(user_id, self.status(user_id))
+        if user_ids:
+            self._watching[ws] = set(user_ids)
+
+    def unwatch(self, ws):
+        for user_id in self._watching.pop(ws, ()):
+            watchers = self._watchers.get(user_id)
+            if watchers is not None:
+                watchers.discard(ws)
+                if not watchers:
+                    del self._watchers[user_id]
+                    self._status.pop(user_id, None)
+
+    def discard(self, ws):
+        """Forget a closed socket."""
+        self.unwatch(ws)
+        self._pending.pop(ws, None)
+
+    # -- changes ----------------------------------------------------------
+
+    def user_changed(self, user_id):
+        status = self.status(user_id)
+        if status == OFFLINE:
+            # Nobody types without a connection
+            for conversation_id, _ in [key for key in self._typing if key[1] == user_id]:
+                self._set_typing(conversation_id, user_id, False, None, forward=False)
+        if user_id not in self._watchers or self._status.get(user_id) == status:
+            return
+        self._status[user_id] = status
+        for ws in self._watchers[user_id]:
+            self._queue(ws, "users", user_id, status)
+
+    def set_typing(self, conversation_id, user_id, typing, member_ids):
+        self._set_typing(conversation_id, user_id, typing, member_ids, forward=True)
+
+    def _set_typing(self, conversation_id, user_id, typing, recipients, forward):
+        key = (conversation_id, user_id)
+        previous = self._typing.pop(key, None)
+        if previous is not None:
+            users = self._typing_users[conversation_id]
+            users.discard(user_id)
+            if not users:
+                del self._typing_users[conversation_id]
+        if typing:
+            recipients = recipients if recipients is not None else previous[1]
+            self._typing[key] = (time.monotonic() + self.typing_ttl, recipients, forward)
+            self._typing_users[conversation_id].add(user_id)
+            self._ensure_running()
+            if previous is not None:
+                return  # Still typing: just extend the expiry
+        elif previous is None:
+            return
+        else:
+            recipients = previous[1]
+            forward = forward or previous[2]
+
+        if forward and fanout.backplane is not None:
+            fanout.backplane.publish(
+                recipients, "typing",
+                {"conversation_id": conversation_id, "user_id": user_id, "typing": typing},
+                coalesce_key=("typing",) + key,
+            )
+        for ws, _ in fanout.sockets_for(recipients):
+            if fanout.owner_of(ws) != user_id:
+                self._queue(ws, "typing", key, typing)
+
+    def _remote_typing(self, user_ids, params):
+        self._set_typing(params["conversation_id"], params["user_id"], params["typing"], user_ids, forward=False)
+
+    def _queue(self, ws, kind, key, value):
+        digest = self._pending.get(ws)
+        if digest is None:
+            digest = self._pending[ws] = {"users": {}, "typing": {}}
+        digest[kind][key] = value
+        self._ensure_running()
+
+    # -- delivery ---------------------------------------------------------
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self._pending or self._typing:
+            await asyncio.sleep(self.flush_interval)
+            self._expire_typing()
+            if self._pending:
+                await self._flush()
+
+    def _expire_typing(self):
+        now = time.monotonic()
+        for (conversation_id, user_id), (expires, _, forward) in list(self._typing.items()):
+            if expires <= now:
+                self._set_typing(conversation_id, user_id, False, None, forward)
+
+    async def _flush(self):
+        pending, self._pending = self._pending, {}
+        sends = []
+        for ws, digest in pending.items():
+            codec = fanout.codec_for(ws)
+            if codec is None:
+                continue
+            params = {}
+            if digest["users"]:
+                params["users"] = [
+                    {"user_id": user_id, "status": status} for user_id, status in digest["users"].items()
+                ]
+            if digest["typing"]:
+                params["typing"] = [
+                    {"conversation_id": conversation_id, "user_id": user_id, "typing": typing}
+                    for (conversation_id, user_id), typing in digest["typing"].items()
+                ]
+            frame = codec.encode_notification("presence", params)
+            sends.append(_send_bounded(ws, frame, codec.text, self.flush_interval * 4))
+        if sends:
+            await asyncio.gather(*sends, return_exceptions=True)
+
+
+presence = PresenceHub()
+
+
+async def _member_ids(conversation_id):
+    # Members are fixed when a conversation is created, so any cached list is
+    # still right and typing/presence never wait for its TTL. Only the first
+    # use of a conversation in this process (or after the LRU evicted it)
+    # queries the DB; without that a member could not type in a
+    # conversation this worker has not served yet.
+    return await _cached_member_ids(conversation_id, max_age=math.inf)
+
+
+def _parse_user_ids(value, limit):
+    if not isinstance(value, list):
+        raise ValueError("not a list")
+    user_ids = {_parse_int(user_id) for user_id in value}
+    if len(user_ids) > limit:
+        raise ValueError("too many users")
+    return user_ids
+
+
+@rpc.method("typing", auth=True, rate_class="presence")
+async def handle_typing(params, current_user=None):
+    try:
+        conversation_id = _parse_int(params.get("conversation_id"))
+    except (TypeError, ValueError):
+        return {"error": "conversation_id required", "code": -32602}
+
+    member_ids = await _member_ids(conversation_id)
+    if current_user.id not in member_ids:
+        return {"error": "Conversation not found", "code": -32602}
+
+    presence.set_typing(conversation_id, current_user.id, params.get("typing", True) is not False, member_ids)
+    return {"message": "ok"}
+
+
+@rpc.method("watch_presence", auth=True, session=True, rate_class="presence")
+async def watch_presence(params, current_user=None, session=None):
+    limit = current_app.config["PRESENCE_MAX_WATCH"]
+    try:
+        user_ids = _parse_user_ids(params.get("user_ids") or [], limit)
+    except (TypeError, ValueError):
+        return {"error": f"user_ids must be a list of at most {limit} user ids", "code": -32602}
+
+    presence.watch(session["ws"], user_ids)
+    return {
+        "message": "Watching presence",
+        "users": [{"user_id": user_id, "status": presence.status(user_id)} for user_id in sorted(user_ids)],
+    }
+
+
+@rpc.method("get_presence", auth=True, rate_class="presence")
+async def get_presence(params, current_user=None):
+    limit = current_app.config["PRESENCE_MAX_WATCH"]
+    try:
+        user_ids = _parse_user_ids(params.get("user_ids") or [], limit)
+        conversation_id = params.get("conversation_id")
+        conversation_id = None if conversation_id is None else _parse_int(conversation_id)
+    except (TypeError, ValueError):
+        return {"error": f"user_ids must be a list of at most {limit} user ids", "code": -32602}
+
+    result = {
+        "message": "Presence fetched",
+        "users": [{"user_id": user_id, "status": presence.status(user_id)} for user_id in sorted(user_ids)],
+    }
+    if conversation_id is not None:
+        member_ids = await _member_ids(conversation_id)
+        if current_user.id not in member_ids:
+            return {"error": "Conversation not found", "code": -32602}
+        result["typing"] = presence.typing_in(conversation_id)
+    return result
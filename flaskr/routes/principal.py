@@ -0,0 +1,89 @@
+import time
+from collections import namedtuple
+from datetime import datetime
+from flaskr.routes.fanout import fanout
+
+# Detached, read-only view of a user that handlers can use without a session
+UserSnapshot = namedtuple("UserSnapshot", ["id", "username", "name", "email", "profile_image"])
+
+# Bumped on profile changes so every connection holding an older snapshot of
+# that user reloads it once instead of serving stale data
+_user_versions = {}
+
+
+def snapshot_user(user):
+    if user is None:
+        return None
+    return UserSnapshot(user.id, user.username, user.name, user.email, user.profile_image)
+
+
+def _timestamp(exp):
+    if isinstance(exp, datetime):
+        return exp.timestamp()
+    return exp
+
+
+def set_principal(session, access_token, claims, user):
+    """Cache the authenticated user on the connection after a token is issued or checked."""
+    session["user_id"] = user.id
+    session["access_token"] = access_token
+    session["principal"] = {
+        "claims": claims,
+        "user": user,
+        "expires_at": _timestamp(claims.get("exp")),
+        "version": _user_versions.get(user.id, 0),
+    }
+    if session.get("ws") is not None:
+        fanout.add(user.id, session["ws"], session["codec"])
+
+
+def update_principal_user(session, user):
+    principal = session.get("principal")
+    if principal and principal["user"].id == user.id:
+        principal["user"] = user
+        principal["version"] = _user_versions.get(user.id, 0)
+
+
+def clear_principal(session):
+    session.pop("principal", None)
+    if session.get("ws") is not None:
+        fanout.discard(session["ws"])
+    session["user_id"] = None
+    session["access_token"] = None
+
+
+def get_principal(session):
+    """Return the cached principal, dropping it once its access token expires.
+
+    The token itself stays on the session so auth checks can still report
+    an expired token and ask the client to refresh.
+    """
+    principal = session.get("principal") if session else None
+    if not principal:
+        return None
+    expires_at = principal["expires_at"]
+    if expires_at is not None and expires_at <= time.time():
+        session.pop("principal", None)
+        return None
+    return principal
+
+
+def is_stale(principal):
+    return principal["version"] != _user_versions.get(principal["user"].id, 0)
+
+
+def invalidate_user(user_id):
+    _bump_version(user_id)
+    # Connections in other worker processes hold snapshots of the user too
+    fanout.broadcast("user_changed", {"user_id": user_id})
+
+
+def _bump_version(user_id):
+    _user_versions[user_id] = _user_versions.get(user_id, 0) + 1
+
+
+def _remote_user_changed(user_ids, params):
+    _bump_version(params["user_id"])
+
+
+fanout.routes["user_changed"] = _remote_user_changed
@@ -0,0 +1,173 @@
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# Token bucket shared by every node: refill, try to take one token, and
+# return how long to wait (0 if the call may go ahead)
+_REDIS_TAKE = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 't', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 't', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+def parse_limits(spec):
+    """Parse ``"read=20/50,write=10/30"`` into {rate_class: (per second, burst)}."""
+    limits = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        rate_class, value = item.split("=", 1)
+        rate, _, burst = value.partition("/")
+        rate = float(rate)
+        if rate <= 0:
+            raise ValueError(f"Rate for '{rate_class}' must be positive")
+        limits[rate_class.strip()] = (rate, float(burst) if burst else max(rate, 1.0))
+    return limits
+
+
+def take(buckets, key, rate, burst, now):
+    """Take one token from ``buckets[key]``; return 0 or the seconds until one is free.
+
+    A bucket is just ``[tokens, last refill time]``, so a check is a dict
+    lookup and a little arithmetic.
+    """
+    bucket = buckets.get(key)
+    if bucket is None:
+        buckets[key] = [burst - 1, now]
+        return 0
+    tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    if tokens >= 1:
+        bucket[0] = tokens - 1
+        return 0
+    bucket[0] = tokens
+    return (1 - tokens) / rate
+
+
+class RateLimiter:
+    """Per-connection and per-user token buckets for each method rate class.
+
+    Connection buckets live on the connection's session and go away with
+    it. User buckets (keyed by user id, or by username for ``auth`` calls
+    such as login) are kept in memory, or in Redis with
+    RATE_LIMIT_BACKEND=redis so a user's limit holds across nodes.
+    """
+
+    def __init__(self, app=None):
+        self._buckets = {}
+        self._pruned_at = time.monotonic()
+        self._redis = None
+        self._script = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config["RATE_LIMIT_ENABLED"]
+        self.connection_limits = parse_limits(app.config["RATE_LIMITS_CONNECTION"])
+        self.user_limits = parse_limits(app.config["RATE_LIMITS_USER"])
+        self.backend = app.config["RATE_LIMIT_BACKEND"]
+        self.redis_url = app.config["RATE_LIMIT_REDIS_URL"]
+        if self.backend not in ("memory", "redis"):
+            raise ValueError(f"Unknown RATE_LIMIT_BACKEND '{self.backend}'")
+
+    def _limit(self, limits, rate_class):
+        return limits.get(rate_class) or limits.get("default")
+
+    def check_connection(self, session, rate_class):
+        limit = self._limit(self.connection_limits, rate_class)
+        if limit is None:
+            return 0
+        buckets = session.get("rate_buckets")
+        if buckets is None:
+            buckets = session["rate_buckets"] = {}
+        return take(buckets, rate_class, limit[0], limit[1], time.monotonic())
+
+    async def check_user(self, user_key, rate_class):
+        limit = self._limit(self.user_limits, rate_class)
+        if limit is None or user_key is None:
+            return 0
+        if self.backend == "redis":
+            return await self._take_redis(f"ratelimit:{rate_class}:{user_key}", *limit)
+
+        now = time.monotonic()
+        if now - self._pruned_at > 60:
+            self._prune(now)
+        return take(self._buckets, (rate_class, user_key), limit[0], limit[1], now)
+
+    def _prune(self, now):
+        # A bucket idle long enough to have refilled is the same as no bucket
+        self._pruned_at = now
+        for key, (tokens, last) in list(self._buckets.items()):
+            rate, burst = self._limit(self.user_limits, key[0])
+            if tokens + (now - last) * rate >= burst:
+                del self._buckets[key]
+
+    async def _take_redis(self, key, rate, burst):
+        if self._redis is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError:
+                raise RuntimeError("RATE_LIMIT_BACKEND=redis needs the 'redis' package installed")
+            self._redis = redis.from_url(self.redis_url)
+            self._script = self._redis.register_script(_REDIS_TAKE)
+        try:
+            return float(await self._script(keys=[key], args=[rate, burst, time.time()]))
+        except Exception as e:
+            # Fail open: an unreachable Redis should not take the chat down
+            log.warning(f"Rate limit check failed: {e}")
+            return 0
+
+
+rate_limiter = RateLimiter()
+
+
+def _user_key(ctx):
+    if ctx.current_user is not None:
+        return ctx.current_user.id
+    if ctx.session and ctx.session.get("user_id"):
+        return ctx.session["user_id"]
+    if ctx.rpc.rate_class == "auth" and isinstance(ctx.params, dict):
+        # Throttle password guessing per account, whichever connection it comes from
+        username = ctx.params.get("username")
+        if isinstance(username, str):
+            return f"username:{username.lower()}"
+    return None
+
+
+def _limited(wait):
+    return {"error": "Rate limit exceeded", "code": -32005, "retry_after": round(wait, 3)}
+
+
+async def connection_rate_limit_middleware(ctx, call_next):
+    """Reject calls over their connection's budget.
+
+    Runs before auth, so a connection flooding calls with bad or missing
+    tokens is throttled before any token check or user lookup.
+    """
+    if not rate_limiter.enabled or ctx.session is None:
+        return await call_next(ctx)
+    wait = rate_limiter.check_connection(ctx.session, ctx.rpc.rate_class)
+    if wait:
+        return _limited(wait)
+    return await call_next(ctx)
+
+
+async def user_rate_limit_middleware(ctx, call_next):
+    """Reject calls over their user's budget; runs after auth has found the user."""
+    if not rate_limiter.enabled:
+        return await call_next(ctx)
+    wait = await rate_limiter.check_user(_user_key(ctx), ctx.rpc.rate_class)
+    if wait:
+        return _limited(wait)
+    return await call_next(ctx)
@@ -1,112 +1,306 @@
-import json
-from flaskr.models import User
-from flaskr.routes.events import (
-    handle_register,
-    handle_login,
-    handle_refresh_token,
-    handle_auth_with_token,
-    get_user_details,
-    get_all_users,
-    handle_upload_profile_picture,
-    get_profile_picture
-)
-
-
-async def send_result(ws, request_id, result):
-    await ws.send(json.dumps({
-        "jsonrpc": "2.0",
-        "id": request_id,
-        "result": result
-    }))
-
-
-async def send_error(ws, request_id, message, code=-32603):
-    await ws.send(json.dumps({
-        "jsonrpc": "2.0",
-        "id": request_id,
-        "error": {
-            "code": code,
-            "message": message
-        }
-    }))
+import asyncio
+import logging
+from http import HTTPStatus
+from flask import current_app
+from flaskr.logs import logs
+from flaskr.metrics import metrics
+from flaskr.routes.codec import get_codec, DecodeError, SUBPROTOCOLS
+from flaskr.routes import events, chat, presence  # noqa: F401  (registers the RPC methods)
+from flaskr.routes.dispatcher import rpc, RpcContext, RpcError
+from flaskr.routes.middleware import error_middleware, timing_middleware, auth_middleware
+from flaskr.routes.outbound import Outbox, outbox_for
+from flaskr.routes.ratelimit import connection_rate_limit_middleware, user_rate_limit_middleware
 
-def _get_session(client_sessions, ws):
-    if ws not in client_sessions:
-        client_sessions[ws] = {"user_id": None, "access_token": None}
-    return client_sessions[ws]
+log = logging.getLogger(__name__)
 
+rpc.use(error_middleware)
+rpc.use(timing_middleware)
+rpc.use(connection_rate_limit_middleware)
+rpc.use(auth_middleware)
+rpc.use(user_rate_limit_middleware)
 
-def _get_session_user(session):
-    user_id = session.get("user_id") if session else None
-    if not user_id:
-        return None
-    return User.query.get(user_id)
 
+# What the codecs raise for values they cannot represent (lone surrogates,
+# oversized ints, unknown types)
+_ENCODE_ERRORS = (TypeError, ValueError, OverflowError)
 
-async def handle_ws_message(ws, message, client_sessions):
-    session = _get_session(client_sessions, ws)
+
+def _result_response(codec, request_id, result):
     try:
-        data = json.loads(message)
-    except json.JSONDecodeError:
-        await send_error(ws, None, "Invalid JSON")
-        return
+        return codec.encode_result(request_id, result)
+    except _ENCODE_ERRORS as e:
+        log.warning(f"Could not encode response with {codec.name}: {e}")
+        return _error_response(codec, request_id, "Response could not be encoded")
+
+
+def _error_response(codec, request_id, message, code=-32603, data=None):
+    metrics.error(code)
+    error = {
+        "code": code,
+        "message": message
+    }
+    if data is not None:
+        error["data"] = data
+    try:
+        return codec.encode_error(request_id, error)
+    except _ENCODE_ERRORS:
+        # The echoed id, error data or a name quoted in the message is what
+        # cannot be encoded
+        safe_message = message.encode("utf-8", "backslashreplace").decode()
+        return codec.encode_error(None, {"code": code, "message": safe_message})
+
+
+async def _send(ws, codec, frame):
+    """Send an encoded frame, or a batch response as its list of encoded responses."""
+    outbox = outbox_for(ws)
+    if outbox is not None:
+        await outbox.put(frame)
+    else:
+        if isinstance(frame, list):
+            frame = codec.encode_batch(frame)
+        metrics.frame("out", len(frame))
+        # Frames are already encoded; text=True stops websockets re-encoding them
+        await ws.send(frame, text=codec.text)
+
+
+def _stream_sender(ws, codec, request_id):
+    async def stream(params):
+        # Partial results are notifications tagged with the request they belong to
+        await _send(ws, codec, codec.encode_notification("stream", {"request_id": request_id, **params}))
+    return stream
+
+
+async def send_result(ws, request_id, result, codec=None):
+    codec = codec or get_codec()
+    await _send(ws, codec, _result_response(codec, request_id, result))
+
+
+async def send_error(ws, request_id, message, code=-32603, data=None, codec=None):
+    codec = codec or get_codec()
+    await _send(ws, codec, _error_response(codec, request_id, message, code, data))
+
+
+def select_subprotocol(connection, subprotocols):
+    """Pick the wire encoding offered by the client, falling back to plain JSON.
+
+    Unlike the websockets default, clients that offer no (or only unknown)
+    subprotocols are still accepted.
+    """
+    for subprotocol in SUBPROTOCOLS:
+        if subprotocol in subprotocols:
+            return subprotocol
+    return None
+
+
+class ConnectionSlots:
+    """Connections admitted and not yet closed, handshakes in progress included.
+
+    Counting at admission rather than by sessions keeps a burst of
+    concurrent handshakes from all passing the check at once.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def acquire(self, max_connections):
+        if max_connections and self.count >= max_connections:
+            return False
+        self.count += 1
+        return True
+
+    def release(self):
+        self.count -= 1
+
+
+def admit_connection(connection, request, slots, max_connections):
+    """Handshake hook: turn clients away with a 503 once the server is full.
+
+    Runs before the WebSocket upgrade, so a rejected client costs one
+    short HTTP response and never gets a session. An admitted client
+    holds its slot until the connection closes, whether or not the
+    handshake completes.
+    """
+    if not slots.acquire(max_connections):
+        response = connection.respond(HTTPStatus.SERVICE_UNAVAILABLE, "Too many connections\n")
+        response.headers["Retry-After"] = "5"
+        return response
+    asyncio.ensure_future(connection.wait_closed()).add_done_callback(lambda _: slots.release())
+    return None
+
+
+def new_session(ws):
+    codec_name = SUBPROTOCOLS.get(getattr(ws, "subprotocol", None), "auto")
+    if codec_name == "auto":
+        codec_name = current_app.config["WS_JSON_CODEC"]
+    codec = get_codec(codec_name)
+    config = current_app.config
+    return {
+        "user_id": None,
+        "access_token": None,
+        "ws": ws,
+        "codec": codec,
+        "outbox": Outbox(
+            ws,
+            codec,
+            high_water=config["WS_SEND_HIGH_WATER"],
+            low_water=config["WS_SEND_LOW_WATER"],
+            policy=config["WS_SLOW_CONSUMER_POLICY"],
+            coalesce=config["WS_COALESCE_FRAMES"],
+            coalesce_bytes=config["WS_COALESCE_MAX_BYTES"],
+        ),
+    }
+
+
+def _get_session(client_sessions, ws):
+    if ws not in client_sessions:
+        client_sessions[ws] = new_session(ws)
+    return client_sessions[ws]
+
+
+async def _handle_request(ws, session, data):
+    """Run one JSON-RPC request object and return its encoded response."""
+    codec = session["codec"]
+    if not isinstance(data, dict):
+        return _error_response(codec, None, "Invalid Request", code=-32600)
 
     if data.get("jsonrpc") != "2.0":
-        await send_error(ws, data.get("id"), "Invalid JSON-RPC version")
-        return
-    
+        return _error_response(codec, data.get("id"), "Invalid JSON-RPC version")
 
     if "id" not in data or data["id"] is None or data["id"] == "":
-        await send_error(ws, None, "Missing 'id' in request")
-        return
+        return _error_response(codec, None, "Missing 'id' in request")
 
     method = data.get("method")
     params = data.get("params", {})
     req_id = data.get("id")
+    # Method names are used as dict keys from here on (logging, rate limits, dispatch)
+    if not isinstance(method, str):
+        return _error_response(codec, req_id, "Invalid Request", code=-32600)
+    logs.frame(method, data, session.get("user_id"))
     token = data.get("access_token")
 
     # Fall back to stored token if client omits it
     if not token:
         token = session.get("access_token")
 
-    current_user = _get_session_user(session)
-
+    ctx = RpcContext(ws, session, req_id, method, params, token, stream=_stream_sender(ws, codec, req_id))
     try:
-        if method == "register":
-            result = await handle_register(params)
-        elif method == "login":
-            result = await handle_login(params)
-            if isinstance(result, dict) and "error" not in result:
-                session["access_token"] = result.get("access_token")
-                session["user_id"] = result.get("user_id")
-
-        elif method == "refresh_token":
-            result = await handle_refresh_token(params)
-            if isinstance(result, dict) and "error" not in result:
-                session["access_token"] = result.get("access_token")
-                session["user_id"] = result.get("user_id", session.get("user_id"))
-
-        elif method == "auth_with_token":
-            result = await handle_auth_with_token(params)
-            if isinstance(result, dict) and "error" not in result:
-                session["user_id"] = result.get("user_id")
-                session["access_token"] = params.get("access_token") or token
-
-        elif method == "get_user_details":
-            result = await get_user_details(params, token=token, current_user=current_user)
-        elif method == "get_all_users":
-            result = await get_all_users(params, token=token, current_user=current_user)
-        elif method == "upload_profile_picture":
-            result = await handle_upload_profile_picture(params, token=token, current_user=current_user)
-        elif method == "get_profile_picture":
-            result = await get_profile_picture(params, token=token, current_user=current_user)
+        result = await rpc.dispatch(ctx)
+    except RpcError as e:
+        return _error_response(codec, req_id, e.message, code=e.code, data=e.data)
+
+    return _result_response(codec, req_id, result)
+
+
+def _changes_session(data):
+    if not isinstance(data, dict) or not isinstance(data.get("method"), str):
+        return False
+    method = rpc.methods.get(data["method"])
+    return method is not None and method.session
+
+
+async def _handle_batch(ws, session, batch):
+    """Run a batch, keeping order only where it matters.
+
+    Calls that change the connection session (login, auth_with_token, ...)
+    act as barriers and run alone, in order; the independent calls between
+    them run concurrently. Responses keep the order of the requests.
+    """
+    responses = []
+    pending = []
+    for data in batch:
+        if _changes_session(data):
+            responses.extend(await asyncio.gather(*pending))
+            pending = []
+            responses.append(await _handle_request(ws, session, data))
         else:
-            await send_error(ws, req_id, f"Unknown method '{method}'", code=-32601)
+            pending.append(_handle_request(ws, session, data))
+    responses.extend(await asyncio.gather(*pending))
+    return responses
+
+
+async def handle_ws_message(ws, message, client_sessions):
+    session = _get_session(client_sessions, ws)
+    codec = session["codec"]
+    try:
+        data = codec.loads(message)
+    except DecodeError:
+        await send_error(ws, None, codec.parse_error, codec=codec)
+        return
+    await _handle_decoded(ws, session, data)
+
+
+async def _handle_decoded(ws, session, data):
+    codec = session["codec"]
+    if isinstance(data, list):
+        if not data:
+            await send_error(ws, None, "Invalid Request: empty batch", code=-32600, codec=codec)
+            return
+        max_batch_size = current_app.config["RPC_MAX_BATCH_SIZE"]
+        if len(data) > max_batch_size:
+            await send_error(ws, None, f"Batch too large (max {max_batch_size} requests)", code=-32600, codec=codec)
             return
+        await _send(ws, codec, await _handle_batch(ws, session, data))
+        return
 
-        if isinstance(result, dict) and "error" in result:
-            await send_error(ws, req_id, result["error"])
-        else:
-            await send_result(ws, req_id, result)
-    except Exception as e:
-        await send_error(ws, req_id, f"Internal error: {str(e)}", code=-32603)
\ No newline at end of file
+    await _send(ws, codec, await _handle_request(ws, session, data))
+
+
+class RequestPipeline:
+    """Runs up to ``limit`` requests from one connection at a time.
+
+    Each frame becomes a task, so a slow call no longer holds up cheaper
+    ones sent after it; responses carry their ``id`` and may arrive out
+    of order. Once ``limit`` requests are running the read loop waits,
+    which pushes back on the client through TCP. Frames that change the
+    session (login, logout, ...) are barriers: they start after every
+    earlier request has finished and finish before any later one starts.
+    """
+
+    def __init__(self, ws, client_sessions, limit):
+        self.ws = ws
+        self.client_sessions = client_sessions
+        self.limit = limit
+        self._slots = asyncio.Semaphore(limit)
+        self._tasks = set()
+
+    async def submit(self, message):
+        metrics.frame("in", len(message))
+        if self.limit <= 1:
+            await handle_ws_message(self.ws, message, self.client_sessions)
+            return
+
+        session = _get_session(self.client_sessions, self.ws)
+        codec = session["codec"]
+        try:
+            data = codec.loads(message)
+        except DecodeError:
+            await send_error(self.ws, None, codec.parse_error, codec=codec)
+            return
+
+        batch = data if isinstance(data, list) else [data]
+        if any(_changes_session(item) for item in batch):
+            await self.drain()
+            await _handle_decoded(self.ws, session, data)
+            return
+
+        await self._slots.acquire()
+        task = asyncio.create_task(_handle_decoded(self.ws, session, data))
+        self._tasks.add(task)
+        task.add_done_callback(self._finished)
+
+    def _finished(self, task):
+        self._tasks.discard(task)
+        self._slots.release()
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Request failed", exc_info=task.exception())
+
+    async def drain(self):
+        """Wait for every running request to finish."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def cancel(self):
+        """Cancel whatever is still running, e.g. once the client has gone."""
+        for task in list(self._tasks):
+            task.cancel()
+        await self.drain()
@@ -0,0 +1,134 @@
+import hashlib
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import jwt
+
+
+class TokenService:
+    """Issues and verifies JWTs, remembering tokens that already passed verification.
+
+    Verified claims are kept in a bounded LRU keyed by the token's SHA-256
+    digest, so a client that sends the same access token on every frame
+    pays for the HMAC check once. Entries are evicted at their ``exp`` and
+    revoked tokens are rejected even while still cached.
+
+    Both the WebSocket loop and the HTTP worker threads verify tokens, so
+    the cache, expiry heap and revocation list are guarded by one lock.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._expiry_heap = []
+        self._revoked = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.secret = app.config["JWT_SECRET_KEY"]
+        if not self.secret:
+            raise RuntimeError("Set JWT_SECRET_KEY or SECRET_KEY (e.g. in .env) to sign access tokens")
+        self.algorithm = app.config["JWT_ALGORITHM"]
+        self.cache_size = app.config["JWT_CACHE_SIZE"]
+        self.lifetimes = {
+            "access": app.config["JWT_ACCESS_TOKEN_EXPIRES"],
+            "refresh": app.config["JWT_REFRESH_TOKEN_EXPIRES"],
+        }
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._expiry_heap.clear()
+            self._revoked.clear()
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def issue(self, user, token_type):
+        claims = {
+            "user_id": user.id,
+            "username": user.username,
+            "type": token_type,
+            "exp": datetime.now(timezone.utc) + self.lifetimes[token_type],
+        }
+        return jwt.encode(claims, self.secret, algorithm=self.algorithm), claims
+
+    def verify(self, token):
+        """Return the token's claims, raising PyJWT's errors like ``jwt.decode``."""
+        digest = self._digest(token)
+        now = time.time()
+        with self._lock:
+            if digest in self._revoked:
+                raise jwt.InvalidTokenError("Token has been revoked")
+
+            claims = self._cache.get(digest)
+            if claims is not None:
+                if claims["exp"] <= now:
+                    del self._cache[digest]
+                    raise jwt.ExpiredSignatureError("Signature has expired")
+                self._cache.move_to_end(digest)
+                return claims
+
+        # The HMAC check runs outside the lock
+        claims = jwt.decode(token, self.secret, algorithms=[self.algorithm])
+        if self.cache_size > 0 and "exp" in claims:
+            with self._lock:
+                # A revoke may have landed while the lock was released
+                if digest in self._revoked:
+                    raise jwt.InvalidTokenError("Token has been revoked")
+                self._remember(digest, claims, now)
+        return claims
+
+    def _remember(self, digest, claims, now):
+        # Called with the lock held
+        self._evict_expired(now)
+        self._cache[digest] = claims
+        heapq.heappush(self._expiry_heap, (claims["exp"], digest))
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _evict_expired(self, now):
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            _, digest = heapq.heappop(heap)
+            self._cache.pop(digest, None)
+        # LRU pops leave dead heap entries behind; rebuild before they pile up
+        if len(heap) > 2 * max(self.cache_size, 1):
+            self._expiry_heap = [(claims["exp"], digest) for digest, claims in self._cache.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def is_revoked(self, token):
+        if not self._revoked:
+            return False
+        digest = self._digest(token)
+        with self._lock:
+            return digest in self._revoked
+
+    def revoke(self, token):
+        """Reject ``token`` from now until it would have expired anyway.
+
+        Returns ``{"digest", "exp"}`` for :meth:`revoke_digest` in other
+        processes, or None if the token is not valid in the first place.
+        """
+        try:
+            claims = jwt.decode(token, self.secret, algorithms=[self.algorithm])
+        except jwt.InvalidTokenError:
+            return None
+        revoked = {"digest": self._digest(token).hex(), "exp": claims.get("exp")}
+        self.revoke_digest(**revoked)
+        return revoked
+
+    def revoke_digest(self, digest, exp):
+        """Apply a revocation made by :meth:`revoke`, possibly in another process."""
+        digest = bytes.fromhex(digest)
+        now = time.time()
+        with self._lock:
+            self._revoked = {d: e for d, e in self._revoked.items() if e > now}
+            self._revoked[digest] = exp if exp is not None else float("inf")
+            self._cache.pop(digest, None)
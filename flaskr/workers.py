@@ -0,0 +1,277 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import signal
+import socket
+import time
+
+log = logging.getLogger(__name__)
+
+# Worker slots use two NODE_IDs each so a replacement started during a
+# rolling restart never hands out message ids from the same node id as
+# the worker it is replacing.
+_IDS_PER_SLOT = 2
+
+
+def _worker_main(slot, node_id, host, port, health, interval, cpu_workers):
+    # Set before flaskr is imported: create_app reads these at import time
+    os.environ["NODE_ID"] = str(node_id)
+    os.environ.setdefault("CPU_EXECUTOR_WORKERS", str(cpu_workers))
+    try:
+        asyncio.run(_serve(slot, node_id, host, port, health, interval))
+    finally:
+        # multiprocessing ends children with os._exit, which skips atexit
+        from flaskr.logs import logs
+        logs.close()
+
+
+async def _serve(slot, node_id, host, port, health, interval):
+    from flaskr.routes.handlers import connected_clients, start_websocket_server
+    from flaskr.routes.message_writer import message_writer
+
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+
+    ready = asyncio.Event()
+
+    def report(state, lag=0.0):
+        health.put({
+            "slot": slot,
+            "pid": os.getpid(),
+            "node_id": node_id,
+            "state": state,
+            "connections": len(connected_clients),
+            "pending_writes": message_writer.queued,
+            "loop_lag_ms": round(lag * 1000, 2),
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        })
+
+    async def reporter():
+        await ready.wait()
+        report("ready")
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            # How late the loop woke us up is a cheap measure of how busy it is
+            report("serving", time.monotonic() - started - interval)
+
+    task = asyncio.create_task(reporter())
+    try:
+        await start_websocket_server(host, port, reuse_port=True, stop=stop, ready=ready)
+    finally:
+        task.cancel()
+        report("stopped")
+
+
+class Supervisor:
+    """Runs ``workers`` WebSocket server processes on one port.
+
+    Every worker binds ``port`` with SO_REUSEPORT, so the kernel spreads
+    new connections across them, and builds its own app, DB engine and
+    event loop. Workers report health every ``health_interval`` seconds;
+    a worker that exits or stops reporting is replaced. SIGHUP restarts
+    the workers one at a time, each replacement serving before its
+    predecessor is told to stop; SIGTERM/SIGINT stop everything
+    gracefully.
+    """
+
+    def __init__(self, workers, host="0.0.0.0", port=8765, health_interval=5,
+                 shutdown_timeout=30, health_file=None):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("Multiple WebSocket workers need SO_REUSEPORT, which this platform lacks")
+        if workers > 1 and os.getenv("BACKPLANE", "memory") == "memory":
+            # Chat fan-out, presence, logouts and profile changes would stay inside one worker
+            raise RuntimeError("Multiple workers need a shared backplane: set BACKPLANE=postgres or BACKPLANE=redis")
+        base_node_id = int(os.getenv("NODE_ID", 0))
+        if base_node_id + workers * _IDS_PER_SLOT > 1024:
+            raise ValueError(f"NODE_ID {base_node_id} leaves no room for {workers} workers")
+
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.health_interval = health_interval
+        self.shutdown_timeout = shutdown_timeout
+        self.health_file = health_file
+        self.base_node_id = base_node_id
+        self.cpu_workers = max(1, (os.cpu_count() or 1) // workers)
+
+        self._ctx = multiprocessing.get_context("spawn")
+        self._health = self._ctx.Queue()
+        self._slots = {}  # slot -> process
+        self._generation = {}  # slot -> restarts so far
+        self._started = {}  # pid -> monotonic start time
+        self._reports = {}  # pid -> (last report, monotonic time)
+        self._retry_at = {}  # slot -> monotonic time a crashed worker may restart
+        self._stopping = False
+        self._rolling = False
+        self._toggle_debug = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGUSR1, self._on_toggle_debug)
+
+        for slot in range(self.workers):
+            self._slots[slot] = self._spawn(slot)
+        log.info(f"Supervising {self.workers} WebSocket workers on ws://{self.host}:{self.port}")
+
+        while not self._stopping:
+            self._poll_health(timeout=1)
+            self._check_workers()
+            if self._rolling:
+                self._rolling_restart()
+            if self._toggle_debug:
+                self._forward_toggle_debug()
+            self._write_health_file()
+
+        log.info("Stopping WebSocket workers")
+        for process in self._slots.values():
+            self._stop(process, wait=False)
+        for process in self._slots.values():
+            self._join(process)
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_reload(self, signum, frame):
+        self._rolling = True
+
+    def _on_toggle_debug(self, signum, frame):
+        self._toggle_debug = True
+
+    def _forward_toggle_debug(self):
+        from flaskr.logs import logs
+
+        self._toggle_debug = False
+        logs.toggle_debug()
+        # Workers started later (restarts, rolling restarts) inherit the setting
+        os.environ["LOG_DEBUG"] = "true" if logs.debug else "false"
+        for process in self._slots.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGUSR1)
+
+    def _spawn(self, slot):
+        generation = self._generation.get(slot, 0)
+        self._generation[slot] = generation + 1
+        node_id = self.base_node_id + slot * _IDS_PER_SLOT + generation % _IDS_PER_SLOT
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(slot, node_id, self.host, self.port, self._health, self.health_interval, self.cpu_workers),
+            name=f"ws-worker-{slot}",
+        )
+        process.start()
+        self._started[process.pid] = time.monotonic()
+        return process
+
+    def _poll_health(self, timeout):
+        try:
+            report = self._health.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        while True:
+            self._reports[report["pid"]] = (report, time.monotonic())
+            if report["state"] == "ready":
+                log.info(f"Worker {report['slot']} (pid {report['pid']}) serving")
+            try:
+                report = self._health.get_nowait()
+            except queue.Empty:
+                return report
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for slot, process in list(self._slots.items()):
+            if not process.is_alive():
+                if slot not in self._retry_at:
+                    # Back off if the worker died soon after starting
+                    quick = now - self._started.get(process.pid, now) < 10
+                    self._retry_at[slot] = now + (5 if quick else 0)
+                    log.error(f"Worker {slot} (pid {process.pid}) exited with {process.exitcode}")
+                if now >= self._retry_at[slot]:
+                    self._forget(process)
+                    del self._retry_at[slot]
+                    self._slots[slot] = self._spawn(slot)
+                continue
+
+            last = self._reports.get(process.pid)
+            if last is None:
+                # Still importing and connecting; allow for a slow start
+                stale = now - self._started[process.pid] > 60
+            else:
+                stale = now - last[1] > 3 * self.health_interval
+            if stale:
+                log.error(f"Worker {slot} (pid {process.pid}) stopped reporting; restarting")
+                process.kill()
+
+    def _rolling_restart(self):
+        self._rolling = False
+        log.info("Rolling restart of WebSocket workers")
+        for slot in range(self.workers):
+            if self._stopping:
+                return
+            old = self._slots[slot]
+            new = self._spawn(slot)
+            if not self._wait_ready(new):
+                log.error(f"Replacement for worker {slot} never became ready; keeping pid {old.pid}")
+                self._stop(new)
+                self._forget(new)
+                continue
+            self._slots[slot] = new
+            self._stop(old)
+            self._forget(old)
+        log.info("Rolling restart finished")
+
+    def _wait_ready(self, process, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and process.is_alive() and not self._stopping:
+            self._poll_health(timeout=0.5)
+            report = self._reports.get(process.pid)
+            if report and report[0]["state"] != "stopped":
+                return True
+        return False
+
+    def _stop(self, process, wait=True):
+        # Workers close their sockets with 1001 (going away) and flush
+        # queued chat messages on SIGTERM
+        if process.is_alive():
+            process.terminate()
+        if wait:
+            self._join(process)
+
+    def _join(self, process):
+        process.join(self.shutdown_timeout)
+        if process.is_alive():
+            log.warning(f"Worker pid {process.pid} ignored SIGTERM; killing it")
+            process.kill()
+            process.join()
+
+    def _forget(self, process):
+        self._started.pop(process.pid, None)
+        self._reports.pop(process.pid, None)
+
+    def health(self):
+        """Latest report per live worker slot, plus seconds since it arrived."""
+        now = time.monotonic()
+        status = []
+        for slot, process in sorted(self._slots.items()):
+            report, seen = self._reports.get(process.pid, ({"slot": slot, "pid": process.pid, "state": "starting"}, None))
+            status.append({
+                **report,
+                "alive": process.is_alive(),
+                "age": None if seen is None else round(now - seen, 1),
+            })
+        return status
+
+    def _write_health_file(self):
+        if not self.health_file:
+            return
+        tmp = f"{self.health_file}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"workers": self.health(), "time": time.time()}, f)
+        os.replace(tmp, self.health_file)
@@ -0,0 +1,59 @@
+# Production server: HTTP and the JSON-RPC WebSocket on one port.
+#
+#   gunicorn -c gunicorn.conf.py flaskr.asgi:application   (or: python run.py)
+#
+# SIGHUP replaces the workers gracefully, SIGTERM drains them for up to
+# GRACEFUL_TIMEOUT seconds, and SIGUSR1 (forwarded to every worker)
+# toggles debug logging of request frames.
+import os
+import tempfile
+from dotenv import load_dotenv
+
+# Same settings as the app reads, so .env also configures the server
+load_dotenv()
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', 8765)}"
+workers = int(os.getenv("WS_WORKERS", 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Idle HTTP keep-alive connections are closed after this many seconds
+keepalive = int(os.getenv("HTTP_KEEPALIVE", 5))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+# Workers build their own app and engines after the fork
+preload_app = False
+
+_base_node_id = int(os.getenv("NODE_ID", 0))
+# Each worker slot owns two NODE_IDs so a replacement started before its
+# predecessor exits (SIGHUP) never shares one; see flaskr/workers.py
+_IDS_PER_SLOT = 2
+
+
+def pre_fork(server, worker):
+    # Message ids embed NODE_ID, so live workers must not share one and a
+    # host must stay inside its own range however often workers restart.
+    # The config module is re-read on SIGHUP, so ids in use come from the
+    # arbiter's workers rather than module state.
+    in_use = {getattr(w, "node_id", None) for w in server.WORKERS.values()}
+    slots = [
+        [node_id for node_id in range(start, start + _IDS_PER_SLOT) if node_id not in in_use]
+        for start in range(_base_node_id, _base_node_id + server.num_workers * _IDS_PER_SLOT, _IDS_PER_SLOT)
+    ]
+    free = max(slots, key=len)
+    if not free:
+        raise RuntimeError(f"No free NODE_ID for a new worker in {_base_node_id}-{_base_node_id + len(slots) * _IDS_PER_SLOT - 1}")
+    worker.node_id = free[0]
+
+
+def post_fork(server, worker):
+    # create_app reads it in the child; the master's environment stays as configured
+    os.environ["NODE_ID"] = str(worker.node_id)
+
+
+def on_starting(server):
+    if _base_node_id + server.cfg.workers * _IDS_PER_SLOT > 1024:
+        raise ValueError(f"NODE_ID {_base_node_id} leaves no room for {server.cfg.workers} workers")
+    if server.cfg.workers > 1 and os.getenv("BACKPLANE", "memory") == "memory":
+        # Chat fan-out, presence, logouts and profile changes would stay inside one worker
+        raise RuntimeError("Multiple workers need a shared backplane: set BACKPLANE=postgres or BACKPLANE=redis")
+    if server.cfg.workers > 1 and not os.getenv("METRICS_DIR"):
+        # A scrape reaches one worker; each publishes here so it can answer for all
+        os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="chat-metrics-")
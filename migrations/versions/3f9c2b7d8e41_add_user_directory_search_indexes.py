@@ -0,0 +1,41 @@
+"""Add user directory search indexes
+
+Revision ID: 3f9c2b7d8e41
+Revises: 7a23a05162ba
+Create Date: 2026-10-18 10:12:41.118203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9c2b7d8e41'
+down_revision = '7a23a05162ba'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Expression indexes backing case-insensitive prefix search in get_all_users.
+    # The ops are keyed by label: a plain sa.text() element has no key, and
+    # SQLAlchemy would silently drop text_pattern_ops (see flaskr/models.py)
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.create_index(
+            'ix_user_lower_username',
+            [sa.func.lower(sa.column('username')).label('lower_username')],
+            unique=False,
+            postgresql_ops={'lower_username': 'text_pattern_ops'},
+        )
+        batch_op.create_index(
+            'ix_user_lower_name',
+            [sa.func.lower(sa.column('name')).label('lower_name')],
+            unique=False,
+            postgresql_ops={'lower_name': 'text_pattern_ops'},
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_lower_name')
+        batch_op.drop_index('ix_user_lower_username')
@@ -0,0 +1,34 @@
+"""Add (conversation_id, id DESC) index for message history
+
+Revision ID: 5d07e3a9c1f6
+Revises: b81d4e6a2c95
+Create Date: 2026-10-18 11:48:03.274551
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d07e3a9c1f6'
+down_revision = 'b81d4e6a2c95'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The composite index serves keyset history scans and also covers
+    # plain conversation_id lookups, so the single-column index goes away
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_message_conversation_id'))
+        batch_op.create_index(
+            'ix_message_conversation_id_id',
+            ['conversation_id', sa.text('id DESC')],
+            unique=False,
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_conversation_id_id')
+        batch_op.create_index(batch_op.f('ix_message_conversation_id'), ['conversation_id'], unique=False)
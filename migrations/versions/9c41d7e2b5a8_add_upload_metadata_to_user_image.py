@@ -0,0 +1,40 @@
+"""Add content hash, variant and size metadata to user_image
+
+Revision ID: 9c41d7e2b5a8
+Revises: e2a6f0b94d37
+Create Date: 2026-10-18 15:07:42.318254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c41d7e2b5a8'
+down_revision = 'e2a6f0b94d37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user_image', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('content_hash', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('variant', sa.String(length=16), server_default='original', nullable=False))
+        batch_op.add_column(sa.Column('content_type', sa.String(length=32), nullable=True))
+        batch_op.add_column(sa.Column('width', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('height', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('byte_size', sa.Integer(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_user_image_content_hash'), ['content_hash'], unique=False)
+        batch_op.create_index('ix_user_image_user_id_content_hash', ['user_id', 'content_hash'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user_image', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_image_user_id_content_hash')
+        batch_op.drop_index(batch_op.f('ix_user_image_content_hash'))
+        batch_op.drop_column('byte_size')
+        batch_op.drop_column('height')
+        batch_op.drop_column('width')
+        batch_op.drop_column('content_type')
+        batch_op.drop_column('variant')
+        batch_op.drop_column('content_hash')
@@ -0,0 +1,32 @@
+"""Widen message.id to BIGINT for application-assigned ids
+
+Revision ID: e2a6f0b94d37
+Revises: 5d07e3a9c1f6
+Create Date: 2026-10-18 12:31:55.906120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a6f0b94d37'
+down_revision = '5d07e3a9c1f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.alter_column('id',
+               existing_type=sa.Integer(),
+               type_=sa.BigInteger(),
+               existing_nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.alter_column('id',
+               existing_type=sa.BigInteger(),
+               type_=sa.Integer(),
+               existing_nullable=False)
@@ -1,16 +1,62 @@
+import argparse
 import asyncio
+import os
+import sys
+import tempfile
 import threading
-from flaskr import create_app
-from flaskr.routes.handlers import start_websocket_server
+from dotenv import load_dotenv
 
-app = create_app()
+ROOT = os.path.dirname(os.path.abspath(__file__))
 
-def run_flask():
+def run_server(workers):
+    """HTTP and WebSocket on one port: gunicorn with uvicorn workers."""
+    args = ["-m", "gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"), "--workers", str(workers)]
+    # Replace this process so gunicorn's master receives the signals directly
+    os.execv(sys.executable, [sys.executable, *args, "flaskr.asgi:application"])
+
+def run_flask(app):
     app.run(host="0.0.0.0", port=5000, debug=False, use_reloader=False)
 
 def run_websocket():
+    from flaskr.routes.handlers import start_websocket_server
     asyncio.run(start_websocket_server())
 
+def run_relay():
+    from flaskr.routes.handlers import run_relay
+    asyncio.run(run_relay())
+
+def run_websocket_workers(workers):
+    from flaskr.workers import Supervisor
+    Supervisor(
+        workers,
+        health_interval=float(os.getenv("WS_HEALTH_INTERVAL", 5)),
+        health_file=os.getenv("WS_HEALTH_FILE"),
+    ).run()
+
 if __name__ == "__main__":
-    threading.Thread(target=run_flask, daemon=True).start()
-    run_websocket()
+    load_dotenv()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("WS_WORKERS", 1)),
+        help="worker processes sharing the port (SIGHUP restarts them gracefully)",
+    )
+    parser.add_argument(
+        "--legacy", action="store_true",
+        help="Werkzeug dev server on :5000 in a thread plus the websockets server on :8765",
+    )
+    args = parser.parse_args()
+
+    if not args.legacy:
+        run_server(args.workers)
+
+    if args.workers > 1 and not os.getenv("METRICS_DIR"):
+        # /metrics here answers for the socket workers too; see flaskr/metrics.py
+        os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="chat-metrics-")
+    from flaskr import get_app
+    threading.Thread(target=run_flask, args=(get_app(),), daemon=True).start()
+    if args.workers > 1:
+        # HTTP runs in this process, the sockets in the workers
+        threading.Thread(target=run_relay, daemon=True).start()
+        run_websocket_workers(args.workers)
+    else:
+        run_websocket()